@@ -1,9 +1,51 @@
 let game = null;
 
+// Ask the server for binary state frames instead of JSON
+const USE_BINARY_PROTOCOL = true;
+const BINARY_SUBPROTOCOL = "pong.binary.v2";
+const STATE_FRAME_TYPE = 1;
+
+// Frames are rendered this many frame intervals in the past, so there is
+// almost always a newer frame to interpolate towards. The interval is the
+// one observed, players and spectators get their frames at different rates.
+const INTERPOLATION_FRAMES = 2;
+// Delay in milliseconds until the interval of the frames is known
+const INITIAL_INTERPOLATION_DELAY = 100;
+// Frames further apart were sent after an idle period, nothing moved between
+// them and they are not interpolated
+const MAX_INTERPOLATION_GAP = 250;
+// A ball moving more than this between two frames was served again
+const MAX_BALL_JUMP = 25;
+const FRAME_BUFFER_SIZE = 32;
+// Milliseconds between two clock syncs, and sync samples kept
+const CLOCK_SYNC_INTERVAL = 5000;
+const CLOCK_SYNC_SAMPLES = 8;
+
 let wrapperFunction = function (event) {
   handleKeyDownArrows(event, game);
 };
 
+let keyUpWrapperFunction = function (event) {
+  handleKeyUpArrows(event, game);
+};
+
+// Keys held when the page loses the focus never get their keyup
+let blurWrapperFunction = function () {
+  releaseHeldKeys(game);
+};
+
+let visibilityWrapperFunction = function () {
+  if (document.hidden) releaseHeldKeys(game);
+};
+
+// Keys that move the paddles and the message sent for each of them
+const PADDLE_KEYS = {
+  ArrowUp: "UP",
+  ArrowDown: "DOWN",
+  w: "W",
+  s: "S",
+};
+
 class Game {
   constructor() {
     this.dx = 1;
@@ -13,6 +55,20 @@ class Game {
     this.dotX = 0;
     this.dotY = 0;
     this.gameSocket = null;
+    this.state = null;
+    this.spectating = false;
+    // Frames received, rendered a few frame intervals late on the server
+    // clock, and the smoothed interval between two frames
+    this.frames = [];
+    this.frameInterval = null;
+    this.clockOffset = null;
+    this.syncSamples = [];
+    this.syncTimer = null;
+    this.animationFrame = null;
+    // Tick on screen, sent with the inputs for the lag compensation
+    this.renderTick = null;
+    // Paddle keys pressed and not released yet
+    this.heldKeys = new Set();
   }
   async getGames(id) {
     let token = Router.getJwt();
@@ -22,6 +78,10 @@ class Game {
       Authorization: "Bearer " + token
     };
 
+    // Watching a game only needs its id
+    let spectate = new URLSearchParams(window.location.search).get("spectate");
+    if (spectate) return { game: { id: spectate }, type: "spectate" };
+
     //Get the oponent from the URL query param
     let oponent = new URLSearchParams(window.location.search).get("opponent");
 
@@ -93,21 +153,50 @@ class Game {
     } else if (gameType === "invitation") {
       let challenge_id = gameData.id;
       socket_params = "&invitation=" + challenge_id;
+    } else if (gameType === "spectate") {
+      socket_params = "&game=" + gameData.id + "&spectate=1";
+      this.spectating = true;
     }
 
     let token = Router.getJwt();
 
     console.log("Connecting to game socket");
 
-    this.gameSocket = new WebSocket(
-      GAME_SOCKETS_HOST + "/game" + "/?token=" + token + socket_params
-    );
+    let url = GAME_SOCKETS_HOST + "/game" + "/?token=" + token + socket_params;
+    // Spectators always get JSON frames
+    if (USE_BINARY_PROTOCOL && !this.spectating) {
+      this.gameSocket = new WebSocket(url, [BINARY_SUBPROTOCOL]);
+      this.gameSocket.binaryType = "arraybuffer";
+    } else {
+      this.gameSocket = new WebSocket(url);
+    }
 
     this.gameSocket.onmessage = async (e) => {
+      if (e.data instanceof ArrayBuffer) {
+        this.parse_frame(e.data);
+        return;
+      }
       const data = JSON.parse(e.data);
 
+      // Answered at once, the server measures the round trip with it
+      if (data.hasOwnProperty("ping")) {
+        this.gameSocket.send(JSON.stringify({ message: "PONG", id: data["ping"] }));
+        return;
+      }
+
       if (data.hasOwnProperty("game_dict")) {
-        this.parse_state(data["game_dict"]);
+        this.state = data["game_dict"];
+        this.pushFrame(this.state);
+        // Frames of the spectators carry the score too
+        if (data.hasOwnProperty("score_dict"))
+          this.changeScore(data["score_dict"]);
+      } else if (data.hasOwnProperty("game_delta")) {
+        // Deltas only carry the fields that changed since the last frame
+        if (this.state === null) return;
+        Object.assign(this.state, data["game_delta"]);
+        this.pushFrame(this.state);
+      } else if (data.hasOwnProperty("sync")) {
+        this.onClockSync(data["sync"]);
       } else if (data.hasOwnProperty("score_dict")) {
         this.changeScore(data["score_dict"]);
       } else if (data.hasOwnProperty("end_dict")) {
@@ -117,6 +206,9 @@ class Game {
           let message = endData["error"];
           await addAlertBox(message, "danger", document.body, 4000);
           Router.changePage("/home/");
+        } else if (this.spectating) {
+          await addAlertBox("The game is over", "success", document.body, 4000);
+          Router.changePage("/home/");
         } else {
           let token = Router.getJwt();
           let headers = {
@@ -145,13 +237,117 @@ class Game {
       }
     };
 
-    this.gameSocket.onopen = function (e) {
+    this.gameSocket.onopen = (e) => {
       console.log("connection");
+      this.syncClock();
+      this.syncTimer = setInterval(() => this.syncClock(), CLOCK_SYNC_INTERVAL);
+      this.animationFrame = requestAnimationFrame(() => this.render());
     };
 
-    this.gameSocket.onclose = function (e) {
+    this.gameSocket.onclose = (e) => {
       console.log("connection closed");
+      clearInterval(this.syncTimer);
+      cancelAnimationFrame(this.animationFrame);
+    };
+  }
+
+  parse_frame(buffer) {
+    // Layout: uint8 type, uint32 tick, float64 server time in ms,
+    // float32 ball x, ball y, paddle left, paddle right
+    let view = new DataView(buffer);
+    if (view.getUint8(0) !== STATE_FRAME_TYPE) return;
+    this.state = {
+      tick: view.getUint32(1, true),
+      time: view.getFloat64(5, true),
+      ball: [view.getFloat32(13, true), view.getFloat32(17, true)],
+      paddle_left: view.getFloat32(21, true),
+      paddle_right: view.getFloat32(25, true),
     };
+    this.pushFrame(this.state);
+  }
+
+  pushFrame(state) {
+    let last = this.frames[this.frames.length - 1];
+    // Frames sent after an idle period say nothing of the rate
+    if (last !== undefined) {
+      let interval = state.time - last.time;
+      if (interval > 0 && interval <= MAX_INTERPOLATION_GAP) {
+        if (this.frameInterval === null) this.frameInterval = interval;
+        else this.frameInterval += (interval - this.frameInterval) / 8;
+      }
+    }
+    // The deltas update the state in place, the buffer keeps copies
+    this.frames.push({
+      tick: state.tick,
+      time: state.time,
+      ball: [state.ball[0], state.ball[1]],
+      paddle_left: state.paddle_left,
+      paddle_right: state.paddle_right,
+    });
+    if (this.frames.length > FRAME_BUFFER_SIZE) this.frames.shift();
+  }
+
+  syncClock() {
+    if (this.gameSocket.readyState !== WebSocket.OPEN) return;
+    this.gameSocket.send(
+      JSON.stringify({ message: "SYNC", client_time: Date.now() })
+    );
+  }
+
+  onClockSync(sync) {
+    let now = Date.now();
+    let rtt = now - sync["client_time"];
+    // The server read its clock about half a round trip ago
+    this.syncSamples.push({ rtt: rtt, offset: sync["server_time"] + rtt / 2 - now });
+    if (this.syncSamples.length > CLOCK_SYNC_SAMPLES) this.syncSamples.shift();
+    // The sample with the shortest round trip is the most accurate one
+    let best = this.syncSamples.reduce((a, b) => (b.rtt < a.rtt ? b : a));
+    this.clockOffset = best.offset;
+  }
+
+  render() {
+    this.animationFrame = requestAnimationFrame(() => this.render());
+    let frames = this.frames;
+    if (frames.length === 0) return;
+    // Until the first clock sync the newest frame is shown as it is
+    if (this.clockOffset === null) {
+      this.showFrame(frames[frames.length - 1]);
+      return;
+    }
+
+    let renderTime = Date.now() + this.clockOffset - this.interpolationDelay();
+    let i = frames.length - 1;
+    while (i > 0 && frames[i].time > renderTime) i--;
+    let from = frames[i];
+    let to = frames[i + 1];
+    if (
+      to === undefined ||
+      from.time > renderTime ||
+      to.time - from.time > MAX_INTERPOLATION_GAP ||
+      Math.abs(to.ball[0] - from.ball[0]) > MAX_BALL_JUMP
+    ) {
+      this.showFrame(from);
+      return;
+    }
+
+    let t = (renderTime - from.time) / (to.time - from.time);
+    let lerp = (a, b) => a + (b - a) * t;
+    this.renderTick = Math.round(lerp(from.tick, to.tick));
+    this.parse_state({
+      ball: [lerp(from.ball[0], to.ball[0]), lerp(from.ball[1], to.ball[1])],
+      paddle_left: lerp(from.paddle_left, to.paddle_left),
+      paddle_right: lerp(from.paddle_right, to.paddle_right),
+    });
+  }
+
+  interpolationDelay() {
+    if (this.frameInterval === null) return INITIAL_INTERPOLATION_DELAY;
+    return INTERPOLATION_FRAMES * this.frameInterval;
+  }
+
+  showFrame(frame) {
+    this.renderTick = frame.tick;
+    this.parse_state(frame);
   }
 
   parse_state(data) {
@@ -284,44 +480,50 @@ class Game {
   }
 }
 
+function sendPaddleKey(game, key, state) {
+  // Only key state changes are sent, the server moves the paddle while the
+  // key is held. The tick on screen lets the server compensate the lag of
+  // the connection and of the interpolation.
+  game.gameSocket.send(
+    JSON.stringify({
+      message: PADDLE_KEYS[key],
+      state: state,
+      tick: game.renderTick,
+    })
+  );
+}
+
+function releaseHeldKeys(game) {
+  if (!game) return;
+  let socket = game.gameSocket;
+  if (socket && socket.readyState === WebSocket.OPEN) {
+    game.heldKeys.forEach((key) => sendPaddleKey(game, key, "release"));
+  }
+  game.heldKeys.clear();
+}
+
 function handleKeyDownArrows(event, game) {
-  switch (event.key) {
-    case "ArrowUp":
-      game.gameSocket.send(
-        JSON.stringify({
-          message: "UP",
-        })
-      );
-      break;
-    case "ArrowDown":
-      game.gameSocket.send(
-        JSON.stringify({
-          message: "DOWN",
-        })
-      );
-      break;
-    case "Enter":
-      console.log("ENTER");
-      game.gameSocket.send(
-        JSON.stringify({
-          message: "ENTER",
-        })
-      );
-      break;
-    case "w":
-      game.gameSocket.send(
-        JSON.stringify({
-          message: "W",
-        })
-      );
-      break;
-    case "s":
-      game.gameSocket.send(
-        JSON.stringify({
-          message: "S",
-        })
-      );
-      break;
+  if (PADDLE_KEYS.hasOwnProperty(event.key)) {
+    if (!event.repeat) {
+      game.heldKeys.add(event.key);
+      sendPaddleKey(game, event.key, "press");
+    }
+    return;
+  }
+  if (event.key === "Enter") {
+    console.log("ENTER");
+    game.gameSocket.send(
+      JSON.stringify({
+        message: "ENTER",
+      })
+    );
+  }
+}
+
+function handleKeyUpArrows(event, game) {
+  if (PADDLE_KEYS.hasOwnProperty(event.key)) {
+    game.heldKeys.delete(event.key);
+    sendPaddleKey(game, event.key, "release");
   }
 }
 
@@ -360,8 +562,17 @@ async function main_game() {
   window.removeEventListener("keydown", wrapperFunction, false);
   window.addEventListener("keydown", wrapperFunction, false);
 
+  window.removeEventListener("keyup", keyUpWrapperFunction, false);
+  window.addEventListener("keyup", keyUpWrapperFunction, false);
+
   window.removeEventListener("keydown", handleKeysPreventDefault, false);
   window.addEventListener("keydown", handleKeysPreventDefault, false);
+
+  window.removeEventListener("blur", blurWrapperFunction, false);
+  window.addEventListener("blur", blurWrapperFunction, false);
+
+  document.removeEventListener("visibilitychange", visibilityWrapperFunction, false);
+  document.addEventListener("visibilitychange", visibilityWrapperFunction, false);
 }
 
 main_game();
@@ -372,7 +583,10 @@ window.addEventListener("change-page", function (event) {
   if (game) {
     if (game.gameSocket) game.gameSocket.close();
     window.removeEventListener("keydown", wrapperFunction, false);
+    window.removeEventListener("keyup", keyUpWrapperFunction, false);
     window.removeEventListener("keydown", handleKeysPreventDefault, false);
+    window.removeEventListener("blur", blurWrapperFunction, false);
+    document.removeEventListener("visibilitychange", visibilityWrapperFunction, false);
     game = null;
   }
   if (event.detail.newPage.includes("/pong/")) {
@@ -18,7 +18,9 @@ from channels.routing import ProtocolTypeRouter, URLRouter, ChannelNameRouter
 from django.urls import path
 import sys
 sys.path.append('../game_sockets')
-from game_sockets.consumers import GameConsumer, ClientConsumer
+from game_sockets.consumers import AsyncGameConsumer, GameConsumer, ClientConsumer, InputConsumer
+from game_sockets.sharding import engine_channel_name, engine_input_channel_name
+from django.conf import settings
 
 #from game_sockets.urls import urlpatterns as websocket_urlpatterns
 
@@ -26,6 +28,9 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'game.settings')
 
 # application = get_asgi_application()
 
+# The control channel runs on the event loop when the engine does
+EngineConsumer = AsyncGameConsumer if settings.GAME_ENGINE_ASYNC else GameConsumer
+
 django_asgi_app = get_asgi_application()
 
 application = ProtocolTypeRouter(
@@ -33,6 +38,11 @@ application = ProtocolTypeRouter(
         "http": django_asgi_app,
         "websocket": AllowedHostsOriginValidator(
             AuthMiddlewareStack(URLRouter([path('ws/game/', ClientConsumer.as_asgi())]))),
-         "channel": ChannelNameRouter({"game_engine": GameConsumer.as_asgi()}),
+         "channel": ChannelNameRouter({
+             **{engine_channel_name(shard): EngineConsumer.as_asgi()
+                for shard in range(settings.GAME_ENGINE_WORKERS)},
+             **{engine_input_channel_name(shard): InputConsumer.as_asgi()
+                for shard in range(settings.GAME_ENGINE_WORKERS)},
+         }),
     }
 )
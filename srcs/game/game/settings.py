@@ -160,11 +160,59 @@ ASGI_APPLICATION = "game.asgi.application"
 
 REDIS_HOST = os.getenv('REDIS_HOST')
 
+# Game engine
+# Number of engine workers, each one runs "runworker game_engine.<shard>"
+GAME_ENGINE_WORKERS = int(os.getenv('GAME_ENGINE_WORKERS', 1))
+GAME_ENGINE_SHARD = int(os.getenv('GAME_ENGINE_SHARD', 0))
+GAME_TICK_RATE = int(os.getenv('GAME_TICK_RATE', 60))
+GAME_MAX_CATCHUP_STEPS = int(os.getenv('GAME_MAX_CATCHUP_STEPS', 5))
+# Ticks between two full state broadcasts, deltas are sent in between
+GAME_KEYFRAME_INTERVAL = int(os.getenv('GAME_KEYFRAME_INTERVAL', 60))
+# Broadcasts per second of every game, at most GAME_TICK_RATE. The clients
+# interpolate between the frames, so it can be well below the tick rate
+GAME_SEND_RATE = int(os.getenv('GAME_SEND_RATE', 30))
+# Frames per second sent to the spectators of a game
+GAME_SPECTATOR_SEND_RATE = int(os.getenv('GAME_SPECTATOR_SEND_RATE', 10))
+# Seconds between two keyframes of a game where nothing moves, 0 sends none
+GAME_IDLE_HEARTBEAT = float(os.getenv('GAME_IDLE_HEARTBEAT', 2.0))
+# Seconds between two writes of the engine updates to the database
+GAME_PERSISTENCE_INTERVAL = float(os.getenv('GAME_PERSISTENCE_INTERVAL', 1.0))
+# Seconds between two pushes of the engine metrics to Redis, 0 disables them
+GAME_METRICS_INTERVAL = float(os.getenv('GAME_METRICS_INTERVAL', 5))
+# Seconds before a disconnected player loses the game, and before a game or
+# an invite nobody joined is cancelled
+GAME_DISCONNECTION_TIMEOUT = int(os.getenv('GAME_DISCONNECTION_TIMEOUT', 30))
+GAME_START_TIMEOUT = int(os.getenv('GAME_START_TIMEOUT', 120))
+GAME_INVITE_TIMEOUT = int(os.getenv('GAME_INVITE_TIMEOUT', 120))
+# Directory of the input logs of the games, to replay them with the
+# replay_game command, empty disables them
+GAME_INPUT_LOG_DIR = os.getenv('GAME_INPUT_LOG_DIR', '')
+# Directory of the binary recordings of the games, served on /replays/,
+# empty disables them
+GAME_RECORDING_DIR = os.getenv('GAME_RECORDING_DIR', '')
+# Seconds between two checkpoints of the games to Redis, 0 disables them
+GAME_CHECKPOINT_INTERVAL = float(os.getenv('GAME_CHECKPOINT_INTERVAL', 1))
+# Simulate every game of a worker at once with numpy
+GAME_ENGINE_BATCH_PHYSICS = os.getenv('GAME_ENGINE_BATCH_PHYSICS', 'False') == 'True'
+# Run the engine in the event loop of the worker instead of a thread
+GAME_ENGINE_ASYNC = os.getenv('GAME_ENGINE_ASYNC', 'True') == 'True'
+# Seconds between two pings of a game socket to measure its round trip
+# time, 0 disables them
+GAME_PING_INTERVAL = float(os.getenv('GAME_PING_INTERVAL', 2.0))
+# Seconds a paddle can be rewound for the hit tests of a player on a slow
+# connection, 0 disables the lag compensation. It covers the interpolation
+# delay of the clients too, which render about 100ms in the past
+GAME_LAG_COMPENSATION = float(os.getenv('GAME_LAG_COMPENSATION', 0.25))
+
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
             "hosts": [(REDIS_HOST, 6379)],
+            # Room for the paddle input of every game of a shard between two reads
+            "channel_capacity": {
+                "game_engine_input.*": 1000,
+            },
         },
     },
 }
@@ -1,9 +1,14 @@
 from .constants import notification_messages
 import json
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
+from django.db import close_old_connections
 from game_matchmaking.models import Tournament, UserTournament
 
+# Notifications are plain HTTP calls, this keeps them off the caller thread
+notification_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="notifications")
+
 
 def send_friend_request_notification(sender, receiver, ntype):
     data = {
@@ -49,3 +54,17 @@ def send_tournament_players_update_notification(tournament):
                                  json=data,
                                  headers={"Authorization": settings.MICROSERVICE_API_TOKEN}, verify=False)
 
+
+def send_tournament_players_update_notification_async(tournament):
+    future = notification_executor.submit(_send_tournament_players_update_job, tournament)
+    future.add_done_callback(_log_notification_error)
+
+def _send_tournament_players_update_job(tournament):
+    # The executor threads live on, their connection may have been dropped
+    # by the database since the last job
+    close_old_connections()
+    send_tournament_players_update_notification(tournament)
+
+def _log_notification_error(future):
+    if future.exception() is not None:
+        print("Error sending notification: ", future.exception())
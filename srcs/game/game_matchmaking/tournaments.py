@@ -0,0 +1,87 @@
+from django.db.models import Q
+
+from .models import Game, Tournament, UserTournament
+from .notifications.send_notification import send_tournament_players_update_notification_async
+
+
+'''
+Create the next game of a tournament, or finish the tournament when only one
+player is still playing
+
+Returns a (body, status) tuple with the response of the nextgame endpoint
+
+Parameters:
+    - tournament_id (Required): The id of the tournament
+'''
+def next_tournament_game(tournament_id):
+    try:
+        tournament = Tournament.objects.get(id=tournament_id)
+    except Tournament.DoesNotExist:
+        return {'error': 'tournament does not exist'}, 404
+    except Exception as e:
+        print("Error while querying the database: ", e)
+        return {'error': 'error while querying the database'}, 500
+
+    try:
+        players_playing = UserTournament.objects.filter(tournament=tournament, status=UserTournament.UserStatus.PLAYING)
+        players_playing_count = players_playing.count()
+    except Exception as e:
+        print("Error while querying the database for the players playing: ", e)
+        return {'error': 'error while querying the database'}, 500
+
+    if players_playing_count == 1:
+        try:
+            winner = players_playing.first().user
+            tournament.tournament_winner = winner
+            tournament.status = Tournament.TournamentStatus.FINISHED
+            tournament.save()
+            return {'winner': winner.username}, 200
+        except Exception as e:
+            print(e)
+            return {'error': 'error while updating the tournament'}, 500
+
+    if players_playing_count == 0:
+        return {'error': 'No players playing'}, 404
+
+    try:
+        players_playing = players_playing.order_by('user__id')
+
+        # Check if the game already exists
+        game = Game.objects.filter(playerLeft=players_playing[0].user,
+                                   playerRight=players_playing[1].user,
+                                   tournament=tournament).filter(Q(status=Game.GameStatus.WAITING) | Q(status=Game.GameStatus.IN_PROGRESS) | Q(status=Game.GameStatus.PAUSED ))
+
+        if game.exists():
+            return {'game': game_summary(game.first())}, 200
+
+        new_game = Game.objects.create(playerLeft=players_playing[0].user, playerRight=players_playing[1].user, tournament=tournament)
+        new_game.save()
+
+        print("Sending notification")
+        send_tournament_players_update_notification_async(tournament)
+
+        return {'game': game_summary(new_game)}, 201
+
+    except Exception as e:
+        print(e)
+        return {'error': 'Error while creating the game'}, 500
+
+
+def game_summary(game):
+    return {'id': game.id, 'status': game.status, "playerLeft": game.playerLeft.username, "playerLeftId": game.playerLeft.id, "playerRight": game.playerRight.username, "playerRightId": game.playerRight.id}
+
+
+'''
+Eliminate the loser of a tournament game and move the tournament forward
+
+Run by the game engine once the game has ended, outside of the tick loop
+'''
+def advance_tournament(tournament_id, loser_id):
+    try:
+        UserTournament.objects.filter(user_id=loser_id, tournament_id=tournament_id).update(status=UserTournament.UserStatus.ELIMINATED)
+    except Exception as e:
+        print("Error saving user tournament: ", e)
+
+    body, status = next_tournament_game(tournament_id)
+    if status >= 400:
+        print("Error advancing tournament %s: " % tournament_id, body)
@@ -8,8 +8,9 @@ from django.shortcuts import get_object_or_404
 import random
 import requests
 
-from .notifications.send_notification import send_friend_request_notification, send_tournament_players_update_notification
+from .notifications.send_notification import send_friend_request_notification
 from .notifications.constants import NotificationType
+from . import tournaments
 
 from rest_framework.views import APIView
 
@@ -405,76 +406,12 @@ def get_top_players(request):
 @api_view(['POST'])
 def next_tournament_game(request):
     tournament_id = request.data.get('tournament_id')
-    tournament = None
 
     if tournament_id is None or tournament_id == '':
         return JsonResponse({'error': 'tournament_id is required'}, status=400)
 
-    try:
-        tournament = Tournament.objects.get(id=tournament_id)
-    except Tournament.DoesNotExist:
-        return JsonResponse({'error': 'tournament does not exist'}, status=404)
-    except Exception as e:
-        print("Error while querying the database: ", e)
-        return JsonResponse({'error': 'error while querying the database'}, status=500)
-
-    try:
-        players_playing = UserTournament.objects.filter(tournament=tournament, status=UserTournament.UserStatus.PLAYING)
-        players_playing_count = players_playing.count()
-    except UserTournament.DoesNotExist:
-        return JsonResponse({'error': 'no players found'}, status=404)
-    except Exception as e:
-        print("Error while querying the database for the players playing: ", e)
-        return JsonResponse({'error': 'error while querying the database'}, status=500)
-    
-    if players_playing_count == 1:
-        try:
-            winner = players_playing.first().user
-            tournament.tournament_winner = winner
-            tournament.status = Tournament.TournamentStatus.FINISHED
-            tournament.save()
-            return JsonResponse({'winner': winner.username}, status=200)
-        except Exception as e:
-            print(e)
-            return JsonResponse({'error': 'error while updating the tournament'}, status=500)
-    
-    if players_playing_count == 0:
-        return JsonResponse({'error': 'No players playing'}, status=404)
-    
-    try:
-        players_playing = players_playing.order_by('user__id')
-
-
-        # Check if the game already exists
-        game = Game.objects.filter(playerLeft=players_playing[0].user,
-                                   playerRight=players_playing[1].user,
-                                   tournament=tournament).filter(Q(status=Game.GameStatus.WAITING) | Q(status=Game.GameStatus.IN_PROGRESS) | Q(status=Game.GameStatus.PAUSED ))
-
-        if game.exists():
-            current_game = game.first()
-            return JsonResponse({'game': {'id': current_game.id, 'status':
-                                current_game.status, "playerLeft":
-                                          current_game.playerLeft.username,
-                                          "playerLeftId":
-                                          current_game.playerLeft.id,
-                                          "playerRight":
-                                          current_game.playerRight.username,
-                                          "playerRightId":
-                                          current_game.playerRight.id}}, status=200)
-        new_game = Game.objects.create(playerLeft=players_playing[0].user, playerRight=players_playing[1].user, tournament=tournament)
-        new_game.save()
-
-        current_game = new_game
-
-
-        print("Sending notification")
-        send_tournament_players_update_notification(tournament)
-
-        return JsonResponse({'game': {'id': current_game.id, 'status': current_game.status, "playerLeft": current_game.playerLeft.username, "playerLeftId": current_game.playerLeft.id, "playerRight": current_game.playerRight.username, "playerRightId": current_game.playerRight.id}}, status=201)
-            
-    except Exception as e:
-        print(e)
-        return JsonResponse({'error': 'Error while creating the game'}, status=500)
+    body, status = tournaments.next_tournament_game(tournament_id)
+    return JsonResponse(body, status=status)
 
 @never_cache
 @api_view(['GET'])
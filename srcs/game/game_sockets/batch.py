@@ -0,0 +1,286 @@
+from django.core.exceptions import ImproperlyConfigured
+
+from .engine import GameInstance
+from .snapshot import GameSnapshot
+from .physics import (BALL_MAX, BALL_MIN, LEFT_PADDLE_FACE, MAX_BOUNCES, PADDLE_HALF_HEIGHT,
+                      RIGHT_PADDLE_FACE)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class BatchPhysics():
+    """
+    Structure of arrays holding the physics state of every game of a worker.
+
+    Every game gets a slot in the arrays, and step() advances all the games
+    that are playing with a kicked ball at once. The swept collision is the
+    same as physics.sweep_ball, applied with masks.
+
+    The last `history_size` positions of the paddles of each game are kept
+    in a ring per slot, for the lag compensation of the hit tests. The ticks
+    of the games and the state of their last broadcast live here too, so the
+    games to send and the fields that changed are found without going
+    through the games one by one.
+    """
+
+    FLOAT_FIELDS = ("x", "y", "vx", "vy", "paddle_left", "paddle_right",
+                    "paddle_left_direction", "paddle_right_direction", "paddle_step",
+                    "sent_x", "sent_y", "sent_paddle_left", "sent_paddle_right")
+    BOOL_FIELDS = ("kicked", "playing", "keyframe_pending")
+    INT_FIELDS = ("rewind_left", "rewind_right", "history_head", "tick", "last_sent_tick", "last_keyframe_tick")
+    # State of the last broadcast, nan until the first one
+    SENT_FIELDS = ("sent_x", "sent_y", "sent_paddle_left", "sent_paddle_right")
+    HISTORY_FIELDS = ("history_left", "history_right")
+
+    def __init__(self, paddle_min, paddle_max, step_scale=1.0, capacity=64, history_size=1):
+        self.paddle_min = paddle_min
+        self.paddle_max = paddle_max
+        self.step_scale = step_scale
+        self.history_size = history_size
+        if np is None:
+            raise ImproperlyConfigured("GAME_ENGINE_BATCH_PHYSICS requires numpy")
+        self.capacity = 0
+        self.games = []
+        self.free_slots = []
+        for name in self.FLOAT_FIELDS:
+            setattr(self, name, np.zeros(0, dtype=np.float64))
+        for name in self.BOOL_FIELDS:
+            setattr(self, name, np.zeros(0, dtype=bool))
+        for name in self.INT_FIELDS:
+            setattr(self, name, np.zeros(0, dtype=np.int64))
+        for name in self.HISTORY_FIELDS:
+            setattr(self, name, np.zeros((0, history_size), dtype=np.float64))
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        for name in self.FLOAT_FIELDS + self.BOOL_FIELDS + self.INT_FIELDS + self.HISTORY_FIELDS:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.capacity] = old
+            setattr(self, name, new)
+        self.games.extend([None] * (capacity - self.capacity))
+        # Lowest slots are handed out first to keep the active games packed
+        self.free_slots.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.free_slots.sort(reverse=True)
+        self.capacity = capacity
+
+    def allocate(self, game):
+        if not self.free_slots:
+            self.grow(self.capacity * 2)
+        slot = self.free_slots.pop()
+        self.games[slot] = game
+        return slot
+
+    def reset_history(self, slot):
+        self.history_left[slot] = self.paddle_left[slot]
+        self.history_right[slot] = self.paddle_right[slot]
+
+    def release(self, slot):
+        self.kicked[slot] = False
+        self.playing[slot] = False
+        self.games[slot] = None
+        self.free_slots.append(slot)
+
+    def clear_sent(self, slot):
+        for name in self.SENT_FIELDS:
+            getattr(self, name)[slot] = np.nan
+
+    def take_frames(self, send_interval, keyframe_interval, heartbeat_ticks):
+        """
+        Find the playing games that send a frame this tick, with the rules of
+        GameEngine.broadcast_state, and record them as sent.
+
+        Returns the slots, whether each frame is a keyframe, whether the
+        ball, the left paddle and the right paddle changed since the last
+        frame, and the state to send, as lists. Games that are not due or
+        where nothing changed are left out without leaving numpy.
+        """
+        since_sent = self.tick - self.last_sent_tick
+        rows = np.flatnonzero(self.playing & (self.keyframe_pending | (since_sent >= send_interval)))
+        if not len(rows):
+            return ([],) * 10
+
+        x, y = self.x[rows], self.y[rows]
+        paddle_left, paddle_right = self.paddle_left[rows], self.paddle_right[rows]
+        tick, since_sent = self.tick[rows], since_sent[rows]
+        # nan is never equal, the first frame has every field
+        ball = (x != self.sent_x[rows]) | (y != self.sent_y[rows])
+        left = paddle_left != self.sent_paddle_left[rows]
+        right = paddle_right != self.sent_paddle_right[rows]
+        changed = ball | left | right
+        if heartbeat_ticks:
+            heartbeat = since_sent >= heartbeat_ticks
+        else:
+            heartbeat = np.zeros_like(changed)
+        keyframe = self.keyframe_pending[rows] | np.where(
+            changed, tick - self.last_keyframe_tick[rows] >= keyframe_interval, heartbeat)
+
+        send = changed | keyframe
+        rows, keyframe, ball, left, right = rows[send], keyframe[send], ball[send], left[send], right[send]
+        x, y, paddle_left, paddle_right, tick = x[send], y[send], paddle_left[send], paddle_right[send], tick[send]
+        self.sent_x[rows] = x
+        self.sent_y[rows] = y
+        self.sent_paddle_left[rows] = paddle_left
+        self.sent_paddle_right[rows] = paddle_right
+        self.last_sent_tick[rows] = tick
+        self.last_keyframe_tick[rows[keyframe]] = tick[keyframe]
+        self.keyframe_pending[rows] = False
+        return (rows.tolist(), keyframe.tolist(), ball.tolist(), left.tolist(), right.tolist(),
+                x.tolist(), y.tolist(), paddle_left.tolist(), paddle_right.tolist(), tick.tolist())
+
+    def step(self):
+        """
+        Advance every active game one step.
+
+        Returns the slots whose ball went out on the left wall and on the
+        right wall, the kicked flag of those games is already cleared.
+        """
+        playing = self.playing
+        np.add(self.tick, 1, out=self.tick, where=playing)
+        for paddle, direction in ((self.paddle_left, self.paddle_left_direction),
+                                  (self.paddle_right, self.paddle_right_direction)):
+            np.add(paddle, direction * self.paddle_step, out=paddle, where=playing)
+            np.clip(paddle, self.paddle_min, self.paddle_max, out=paddle)
+
+        if self.history_size > 1:
+            rows = np.flatnonzero(playing)
+            head = (self.history_head[rows] + 1) % self.history_size
+            self.history_head[rows] = head
+            self.history_left[rows, head] = self.paddle_left[rows]
+            self.history_right[rows, head] = self.paddle_right[rows]
+
+        active = self.kicked & playing
+        if not active.any():
+            return (), ()
+
+        # A paddle that is not rewound is its own rewound position
+        if self.history_size > 1:
+            slots = np.arange(self.capacity)
+            rewound_left = self.history_left[slots, (self.history_head - self.rewind_left) % self.history_size]
+            rewound_right = self.history_right[slots, (self.history_head - self.rewind_right) % self.history_size]
+        else:
+            rewound_left, rewound_right = self.paddle_left, self.paddle_right
+
+        x, y, vx, vy = self.x, self.y, self.vx, self.vy
+        remaining = np.where(active, self.step_scale, 0.0)
+        moving = active.copy()
+        left_goal = np.zeros_like(active)
+        right_goal = np.zeros_like(active)
+
+        # Balls standing still on an axis get infinite times, and nan
+        # positions that fail every comparison
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for _ in range(MAX_BOUNCES + 1):
+                t_wall = np.where(vy < 0, (BALL_MIN - y) / vy, np.where(vy > 0, (BALL_MAX - y) / vy, np.inf))
+                np.maximum(t_wall, 0.0, out=t_wall)
+
+                t = np.where(vx > 0, (RIGHT_PADDLE_FACE - x) / vx, (LEFT_PADDLE_FACE - x) / vx)
+                paddles = np.where(vx > 0, self.paddle_right, self.paddle_left)
+                rewound = np.where(vx > 0, rewound_right, rewound_left)
+                contact = y + vy * t
+                covered = (np.abs(contact - paddles) < PADDLE_HALF_HEIGHT) | (np.abs(contact - rewound) < PADDLE_HALF_HEIGHT)
+                facing = np.where(vx > 0, x <= RIGHT_PADDLE_FACE, (vx < 0) & (x >= LEFT_PADDLE_FACE))
+                t_paddle = np.where(facing & covered, t, np.inf)
+
+                t_goal = np.where(vx > 0, (BALL_MAX - x) / vx, np.where(vx < 0, (BALL_MIN - x) / vx, np.inf))
+                np.maximum(t_goal, 0.0, out=t_goal)
+
+                t = np.minimum(np.minimum(t_wall, t_paddle), np.minimum(t_goal, remaining))
+                t[~moving] = 0.0
+                np.add(x, vx * t, out=x, where=moving)
+                np.add(y, vy * t, out=y, where=moving)
+                remaining -= t
+
+                goal = moving & (t_goal == t)
+                left_goal |= goal & (vx < 0)
+                right_goal |= goal & (vx > 0)
+                wall = moving & ~goal & (t_wall == t)
+                paddle = moving & ~goal & (t_paddle == t)
+                np.negative(vy, out=vy, where=wall)
+                np.negative(vx, out=vx, where=paddle)
+
+                moving &= wall | paddle
+                if not moving.any():
+                    break
+
+        self.kicked[left_goal | right_goal] = False
+        return np.flatnonzero(left_goal).tolist(), np.flatnonzero(right_goal).tolist()
+
+
+def _batch_field(name, cast):
+    def getter(self):
+        return cast(getattr(self.batch, name)[self.slot])
+
+    def setter(self, value):
+        getattr(self.batch, name)[self.slot] = value
+
+    return property(getter, setter)
+
+
+class BatchGameInstance(GameInstance):
+    """
+    GameInstance whose ball and paddles live in a BatchPhysics slot.
+    """
+
+    dotX = _batch_field("x", float)
+    dotY = _batch_field("y", float)
+    speedX = _batch_field("vx", float)
+    speedY = _batch_field("vy", float)
+    paddle_left = _batch_field("paddle_left", float)
+    paddle_right = _batch_field("paddle_right", float)
+    dotKicked = _batch_field("kicked", bool)
+    paddleLeftDirection = _batch_field("paddle_left_direction", int)
+    paddleRightDirection = _batch_field("paddle_right_direction", int)
+    rewind_left = _batch_field("rewind_left", int)
+    rewind_right = _batch_field("rewind_right", int)
+    tick = _batch_field("tick", int)
+    last_sent_tick = _batch_field("last_sent_tick", int)
+    last_keyframe_tick = _batch_field("last_keyframe_tick", int)
+    keyframe_pending = _batch_field("keyframe_pending", bool)
+
+    def __init__(self, group_name, persistence, batch, paddle_speed, seed=None):
+        self.batch = batch
+        self.slot = batch.allocate(self)
+        super().__init__(group_name, persistence, seed)
+        batch.paddle_step[self.slot] = self.dx * paddle_speed
+        self.reset_paddle_history()
+
+    def reset_paddle_history(self):
+        if self.slot is not None:
+            self.batch.reset_history(self.slot)
+
+    @property
+    def sent_snapshot(self):
+        batch, slot = self.batch, self.slot
+        if np.isnan(batch.sent_x[slot]):
+            return None
+        return GameSnapshot(float(batch.sent_paddle_right[slot]), float(batch.sent_paddle_left[slot]),
+                            (float(batch.sent_x[slot]), float(batch.sent_y[slot])), self.last_sent_tick)
+
+    @sent_snapshot.setter
+    def sent_snapshot(self, snapshot):
+        batch, slot = self.batch, self.slot
+        if snapshot is None:
+            batch.clear_sent(slot)
+            return
+        batch.sent_x[slot], batch.sent_y[slot] = snapshot.ball
+        batch.sent_paddle_left[slot] = snapshot.paddle_left
+        batch.sent_paddle_right[slot] = snapshot.paddle_right
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, value):
+        self._status = value
+        self.batch.playing[self.slot] = value == self.GameStatus.PLAYING
+
+    def release(self):
+        if self.slot is None:
+            return
+        self.batch.release(self.slot)
+        self.slot = None
@@ -0,0 +1,67 @@
+import json
+import threading
+
+import redis
+from django.conf import settings
+
+CHECKPOINT_KEY_PREFIX = "game_engine:checkpoints:"
+
+
+class CheckpointStore(threading.Thread):
+    """
+    Keeps a checkpoint of every game of an engine shard in a Redis hash, so a
+    restarted worker, or the one taking over the shard, can resume them.
+
+    The engine thread only hands over the state of the games, the latest
+    state of each game is written by this thread.
+    """
+
+    def __init__(self, shard, **kwargs):
+        super().__init__(daemon=True, name="CheckpointStore", **kwargs)
+        self.key = CHECKPOINT_KEY_PREFIX + shard
+        self.redis = redis.Redis(host=settings.REDIS_HOST, port=6379)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # group_name -> state, or None when the checkpoint has to be deleted
+        self.pending = {}
+
+    def save(self, group_name, state):
+        with self.lock:
+            self.pending[group_name] = state
+        self.wakeup.set()
+
+    def delete(self, group_name):
+        with self.lock:
+            self.pending[group_name] = None
+        self.wakeup.set()
+
+    def load(self):
+        checkpoints = {}
+        try:
+            for group_name, value in self.redis.hgetall(self.key).items():
+                checkpoints[group_name.decode()] = json.loads(value)
+        except redis.RedisError as e:
+            print("Error loading checkpoints: ", e)
+        return checkpoints
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.write()
+
+    def write(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for group_name, state in pending.items():
+            if state is None:
+                pipe.hdel(self.key, group_name)
+            else:
+                pipe.hset(self.key, group_name, json.dumps(state, separators=(",", ":")))
+        try:
+            pipe.execute()
+        except redis.RedisError as e:
+            print("Error saving checkpoints: ", e)
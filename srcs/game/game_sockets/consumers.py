@@ -1,10 +1,18 @@
+import asyncio
 import json
-from channels.consumer import SyncConsumer
+import time
+from channels.consumer import AsyncConsumer, SyncConsumer
+from channels.exceptions import ChannelFull
 from channels.generic.websocket import AsyncWebsocketConsumer
-from .engine import GameEngine
+from .engine import get_engine
+from .sharding import engine_channel_for, engine_input_channel_for
+from .protocol import BINARY_SUBPROTOCOL, sync_reply
+from .spectators import spectator_group_name
+from .network import NetworkQuality
 
 from game_matchmaking.models import Game, GameInvite
 from django.db.models import Q
+from django.conf import settings
 
 from urllib.parse import parse_qs
 from .auth.jwt import validate_jwt_and_get_user_id
@@ -21,6 +29,16 @@ class ClientConsumer(AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.group_name = "pong"
+        self.engine_channel = None
+        self.input_channel = None
+        self.binary = False
+        # Spectators only receive the frames of the spectator group
+        self.spectating = False
+        # Pings waiting for their pong, by id, and the measures of the socket
+        self.pings = {}
+        self.ping_id = 0
+        self.ping_task = None
+        self.network = NetworkQuality()
  
     async def connect(self):
 
@@ -46,6 +64,9 @@ class ClientConsumer(AsyncWebsocketConsumer):
         # Check the query parameters for the game id or invite id
         game_id = query_dict.get("game", None)
         invite_id = query_dict.get("invitation", None)
+        tournament_id = None
+        # Only an existing game can be watched
+        self.spectating = bool(game_id) and "spectate" in query_dict
 
         if game_id:
             try:
@@ -53,6 +74,7 @@ class ClientConsumer(AsyncWebsocketConsumer):
                 game = await database_sync_to_async(Game.objects.get)(id=game_id)
                 playerLeft_id = await sync_to_async(lambda: game.playerLeft.id)()
                 playerRight_id = await sync_to_async(lambda: game.playerRight.id)()
+                tournament_id = game.tournament_id
                 self.group_name = "game_" + str(playerLeft_id) + "_" + str(playerRight_id)
             except Game.DoesNotExist:
                 await self.close()
@@ -81,43 +103,109 @@ class ClientConsumer(AsyncWebsocketConsumer):
 
         print("Group name: ", self.group_name)
 
+        # Every game is simulated by the engine worker that owns its group
+        self.engine_channel = engine_channel_for(self.group_name)
+        self.input_channel = engine_input_channel_for(self.group_name)
+
+        if self.spectating:
+            # Only the sockets of the players are measured, for their hit tests
+            await self.channel_layer.group_add(spectator_group_name(self.group_name), self.channel_name)
+            await self.accept()
+            await self.channel_layer.send(self.engine_channel, {"type": "spectator.join",
+                                                                "message": {"group_name": self.group_name}})
+            return
+
         await self.channel_layer.group_add(self.group_name, self.channel_name)
-        await self.accept()
 
-        await self.start(self.group_name, user_id, game_id, invite_id)
+        # Clients that offer the binary subprotocol get the state as bytes
+        if BINARY_SUBPROTOCOL in self.scope.get("subprotocols", []):
+            self.binary = True
+            await self.accept(subprotocol=BINARY_SUBPROTOCOL)
+        else:
+            await self.accept()
+        self.start_pings()
 
-    async def receive(self, text_data):
+        await self.start(self.group_name, user_id, game_id, invite_id, tournament_id)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if text_data is None:
+            return
         text_data_json = json.loads(text_data)
         message = text_data_json["message"]
-        return await self.movement(message)
+        # Clock sync of the interpolation, answered here so the round trip
+        # is the one of the connection only
+        if message == "SYNC":
+            await self.send(text_data=sync_reply(text_data_json.get("client_time")))
+            return
+        if message == "PONG":
+            return await self.pong(text_data_json.get("id"))
+        if self.spectating:
+            return
+        # "press" or "release" for the key-state input model, None for the
+        # legacy one message per key repeat input
+        state = text_data_json.get("state")
+        # Tick of the last frame the client got, for the lag compensation
+        tick = text_data_json.get("tick")
+        if not isinstance(tick, int):
+            tick = None
+        return await self.movement(message, state, tick)
 
-    # Receive message from room group
-    async def game_update(self, event):
-        # print("game_update " + self.group_name)
-        game_dict = None
-        try:
-            game_dict = event["game_dict"]
-            await self.send(text_data=json.dumps({"game_dict": game_dict}))
-        except:
-            pass
+    def start_pings(self):
+        if settings.GAME_PING_INTERVAL:
+            self.ping_task = asyncio.ensure_future(self.ping_loop())
+
+    async def ping_loop(self):
+        while True:
+            await asyncio.sleep(settings.GAME_PING_INTERVAL)
+            self.ping_id += 1
+            self.pings[self.ping_id] = time.perf_counter()
+            # Pings lost on the way are forgotten
+            if len(self.pings) > 8:
+                self.pings.pop(next(iter(self.pings)))
+            await self.send(text_data=json.dumps({"ping": self.ping_id}))
+
+    async def pong(self, ping_id):
+        sent = self.pings.pop(ping_id, None)
+        if sent is None:
+            return
+        self.network.observe(time.perf_counter() - sent)
+        # The engine of the game aggregates the measures of its connections.
+        # They go with the inputs, the control channel is kept for the
+        # lifecycle messages, and a measure is dropped when the engine is
+        # behind
         try:
-            game_dict = event["score_dict"]
-            await self.send(text_data=json.dumps({"score_dict": game_dict}))
-        except:
+            await self.channel_layer.send(self.input_channel, {"type": "player.network",
+                                                               "message": {"user_id": self.user_id,
+                                                                           "network": self.network.to_dict()}})
+        except ChannelFull:
             pass
-        try:
-            game_dict = event["end_dict"]
-            await self.send(text_data=json.dumps({"end_dict": game_dict}))
-            await self.channel_layer.send("game_engine", {"type":"game.end",
-                                          "message": { "group_name":
-                                                      self.group_name
-                                                      }})
+
+    # Frame of the spectator group, serialized once by the engine
+    async def spectator_update(self, event):
+        await self.send(text_data=event["text"])
+        if event.get("close"):
             await self.close()
-        except:
-            pass
 
-    async def start(self, group_name, user_id, game_id=None, invite_id=None):
-        await self.channel_layer.send("game_engine", {"type":"player.start",
+    # Frames of the players' group, serialized once by the engine
+    async def game_frame(self, event):
+        if self.binary:
+            await self.send(bytes_data=event["bytes"])
+        else:
+            await self.send(text_data=event["text"])
+
+    async def score_update(self, event):
+        await self.send(text_data=event["text"])
+
+    async def game_end(self, event):
+        await self.send(text_data=event["text"])
+        await self.channel_layer.send(self.engine_channel, {"type":"game.end",
+                                      "message": { "group_name":
+                                                  self.group_name
+                                                  }})
+        await self.close()
+
+    async def start(self, group_name, user_id, game_id=None, invite_id=None, tournament_id=None):
+        await self.channel_layer.send(self.engine_channel, {"type":"player.start",
                                                       "message": { "group_name":
                                                                   group_name,
                                                                   "user_id":
@@ -125,21 +213,39 @@ class ClientConsumer(AsyncWebsocketConsumer):
                                                                   "game_id":
                                                                     game_id,
                                                                   "invite_id":
-                                                                    invite_id
+                                                                    invite_id,
+                                                                  "tournament_id":
+                                                                    tournament_id
                                                                   }})
 
-    async def movement(self, msg: str):
-        await self.channel_layer.send("game_engine", {"type":"player.movement" ,
-                                                      "message": msg,
-                                                      "user_id": self.user_id,
-                                                      "group_name" : self.group_name} )
+    async def movement(self, msg: str, state=None, tick=None):
+        # The input channel is full when the engine is behind. The input is
+        # dropped, the mailbox would only keep the latest one anyway
+        try:
+            await self.channel_layer.send(self.input_channel, {"type":"player.movement" ,
+                                                          "message": msg,
+                                                          "state": state,
+                                                          "tick": tick,
+                                                          "user_id": self.user_id,
+                                                          "group_name" : self.group_name} )
+        except ChannelFull:
+            pass
  
     async def disconnect(self, message, **kwargs):
         """
         Perform things on connection close
         """
         # await self.channel_layer.group_discard(self.group_name, self.channel_name)
-        await self.channel_layer.send("game_engine", {"type":"player.disconnect",
+        if self.ping_task is not None:
+            self.ping_task.cancel()
+        if self.engine_channel is None:
+            return
+        if self.spectating:
+            await self.channel_layer.group_discard(spectator_group_name(self.group_name), self.channel_name)
+            await self.channel_layer.send(self.engine_channel, {"type": "spectator.leave",
+                                                                "message": {"group_name": self.group_name}})
+            return
+        await self.channel_layer.send(self.engine_channel, {"type":"player.disconnect",
                                                         "message": { "group_name":
                                                                     self.group_name,
                                                                     "user_id": self.user_id
@@ -149,34 +255,89 @@ class GameConsumer(SyncConsumer):
     def __init__(self, *args, **kwargs):
         """
         Created on demand when the first player joins.
+
+        The engine ticks in its own thread, the messages are handed to it
+        and run at the start of its next tick.
         """
         # print("Game Consumer: %s %s", args, kwargs)
         super().__init__(*args, **kwargs)
         self.group_name = "pong"
-        self.engine = GameEngine(self.group_name)
-        self.engine.start()
+        self.engine = get_engine(settings.GAME_ENGINE_SHARD)
 
     def player_start(self, event):
         msg = event.get("message")
         print(msg)
         game_id = msg.get("game_id")
         invite_id = msg.get("invite_id")
-        self.engine.add_player(msg.get("group_name"), msg.get("user_id"), game_id, invite_id)
+        self.engine.submit(self.engine.add_player, msg.get("group_name"), msg.get("user_id"), game_id, invite_id,
+                           msg.get("tournament_id"))
 
     def player_disconnect(self, event):
         msg = event.get("message")
         print(msg)
-        self.engine.remove_player(msg.get("group_name"), msg.get("user_id"))
+        self.engine.submit(self.engine.remove_player, msg.get("group_name"), msg.get("user_id"))
 
     def game_end(self, event):
+        msg = event.get("message")
+        print(msg)
+        self.engine.submit(self.engine.end_game, msg.get("group_name"))
+
+    def spectator_join(self, event):
+        self.engine.submit(self.engine.spectator_join, event.get("message").get("group_name"))
+
+    def spectator_leave(self, event):
+        self.engine.submit(self.engine.spectator_leave, event.get("message").get("group_name"))
+
+
+class AsyncGameConsumer(AsyncConsumer):
+    """
+    Control channel of the shard when the engine runs in the event loop of
+    the worker: the engine is called from the handlers, on the same loop.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.engine = get_engine(settings.GAME_ENGINE_SHARD)
+
+    async def player_start(self, event):
+        msg = event.get("message")
+        print(msg)
+        self.engine.add_player(msg.get("group_name"), msg.get("user_id"), msg.get("game_id"), msg.get("invite_id"),
+                               msg.get("tournament_id"))
+
+    async def player_disconnect(self, event):
+        msg = event.get("message")
+        print(msg)
+        self.engine.remove_player(msg.get("group_name"), msg.get("user_id"))
+
+    async def game_end(self, event):
         msg = event.get("message")
         print(msg)
         self.engine.end_game(msg.get("group_name"))
 
-    def player_movement(self, event):
-        message = event.get("message")
-        group_name = event.get("group_name")
-        user_id = event.get("user_id")
-        self.engine.update_paddle_position(user_id, message, group_name)
-        if message == "ENTER":
-            self.engine.kick_dot(group_name)
+    async def spectator_join(self, event):
+        self.engine.spectator_join(event.get("message").get("group_name"))
+
+    async def spectator_leave(self, event):
+        self.engine.spectator_leave(event.get("message").get("group_name"))
+
+
+class InputConsumer(AsyncConsumer):
+    """
+    Paddle input of the shard. Messages are only queued in the mailbox of
+    the engine, which applies them at the start of its next tick, so the
+    input stream is drained as fast as it arrives.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.engine = get_engine(settings.GAME_ENGINE_SHARD)
+
+    async def player_movement(self, event):
+        self.engine.inputs.put(event.get("group_name"), event.get("user_id"), event.get("message"), event.get("state"),
+                               event.get("tick"))
+
+    async def player_network(self, event):
+        # Applied with the control messages, from the thread of the engine
+        msg = event.get("message")
+        self.engine.submit(self.engine.player_network, msg.get("user_id"), msg.get("network"))
@@ -1,33 +1,64 @@
+import asyncio
+import atexit
+import math
+import signal
+import sys
 import threading
 import random
 import time
+import traceback
+from collections import deque
+from datetime import datetime, timezone as dt_timezone
 
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
-from game_matchmaking.models import Game, GameInvite, Tournament, UserTournament
-from django.contrib.auth.models import User
+from game_matchmaking.models import Game, GameInvite
+from game_matchmaking.tournaments import advance_tournament
 from django.utils import timezone
 from django.conf import settings
 
-from game_matchmaking.notifications.send_notification import send_tournament_players_update_notification
+from .scheduler import TickScheduler
+from .persistence import GamePersistence
+from .metrics import EngineMetrics, MetricsPublisher
+from .checkpoint import CheckpointStore
+from .timers import DeadlineHeap
+from .inputs import InputMailbox
+from .sharding import engine_channel_name
+from .physics import sweep_ball
+from .replay import InputLog, append_input_log, input_log_path
+from .recording import EVENT_FINISHED, EVENT_GOAL_LEFT, EVENT_GOAL_RIGHT, RecordingWriter
+from .spectators import LoopFanout, SpectatorFanout
+from .protocol import end_event, score_event, server_time, state_event
+from .snapshot import GameSnapshot, snapshot_delta
 
-import requests
+
+def cancel_pending_invite(invite_id):
+    GameInvite.objects.filter(id=invite_id, status=GameInvite.InviteStatus.PENDING).update(
+        status=GameInvite.InviteStatus.CANCELLED)
 
 class GameInstance():
-    def __init__(self, group_name):
+    def __init__(self, group_name, persistence, seed=None):
         self.channel_layer = get_channel_layer()
+        self.persistence = persistence
+
+        # Every random choice of the game comes from its seed, so it can be
+        # simulated again from the seed and its input log
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        rng = random.Random(self.seed)
+        self.input_log = None
+        self.recording = None
+        # Set by the engine, so the messages of the game take its send path
+        self.sender = None
 
         self.game_id = None
         self.invite_id = None
-
-        self.game: Game
-        self.invite = None
+        self.tournament_id = None
 
         # Game status
-        self.dx = random.choice([2.5, 2])
+        self.dx = rng.choice([2.5, 2])
         self.group_name = group_name
-        self.dy = random.choice([2.5, 2])
+        self.dy = rng.choice([2.5, 2])
         self.paddle_right = 50
         self.paddle_left = 50
         self.court_top = 0
@@ -36,16 +67,20 @@ class GameInstance():
         self.dotX = 50
         self.dotY = 50
 
-        self.speedX= self.dx*random.choice([-1, 1]) * 0.5
-        self.speedY= self.dy*random.choice([-1, 1]) * 0.5
+        self.speedX= self.dx*rng.choice([-1, 1]) * 0.5
+        self.speedY= self.dy*rng.choice([-1, 1]) * 0.5
         self.started = True
         self.dotKicked = False
 
-        self.game_state = {
-            'paddle_right': self.paddle_left,
-            'paddle_left': self.paddle_right,
-            'ball':[self.dotX,self.dotY] 
-        }
+        # Keys held by each player: -1 up, 1 down, 0 none
+        self.paddleLeftDirection = 0
+        self.paddleRightDirection = 0
+
+        # Lag compensation: positions of the paddles in the last steps, and
+        # how many steps back the paddle of each player is also hit tested
+        self.paddle_history = None
+        self.rewind_left = 0
+        self.rewind_right = 0
 
         self.status = self.GameStatus.WAITING
 
@@ -62,6 +97,19 @@ class GameInstance():
         self.start_time = timezone.now()
         self.connection_time = None
 
+        # Simulation steps run while playing, and the last snapshot sent to
+        # the group, used to broadcast only the fields that changed
+        self.tick = 0
+        self.snapshot = None
+        self.sent_snapshot = None
+        self.last_keyframe_tick = 0
+        self.keyframe_pending = True
+        self.last_sent_tick = 0
+        self.last_spectator_tick = 0
+        self.spectator_pending = True
+        self.winner_id = None
+        self.take_snapshot()
+
     class GameStatus():
         WAITING = "WAITING"
         PLAYING = "IN_PROGRESS"
@@ -83,7 +131,10 @@ class GameInstance():
     class PlayersDisconnectedError(GameError):
         pass
 
-    def add_player(self, user_id, game_id, invite_id):
+    def add_player(self, user_id, game_id, invite_id, tournament_id=None):
+        # Whoever (re)joins needs the full state
+        self.keyframe_pending = True
+
         if game_id and self.game_id != game_id and self.game_id is not None:
             print("Error: game_id mismatch")
             raise self.GameMismatchError
@@ -91,21 +142,18 @@ class GameInstance():
             print("Error: invite_id mismatch")
             raise self.GameMismatchError
 
+        # The game and the invite were already looked up by the consumer
         if game_id:
             self.game_id = game_id
-            try:
-                self.game = Game.objects.get(id=game_id)
-            except Game.DoesNotExist:
-                print("Error: game not found")
-                raise self.GameNotFoundError
+            if tournament_id:
+                self.tournament_id = tournament_id
         elif invite_id:
             self.invite_id = invite_id
-            try:
-                self.invite = GameInvite.objects.get(id=invite_id)
-            except GameInvite.DoesNotExist:
-                print("Error: invite not found")
-                raise self.GameNotFoundError
 
+        # The connections pause and resume the game, the replay goes through
+        # them again
+        if self.input_log is not None:
+            self.input_log.connection(self.tick, user_id, True)
 
         if self.playerLeftId == user_id:
             self.playerLeftStatus = self.PlayerStatus.PLAYING
@@ -115,27 +163,27 @@ class GameInstance():
             self.connection_time = timezone.now()
 
         if self.connection_time is not None:
-            try:
-                self.game.connection_time = self.connection_time
-                self.game.save()
-            except Exception as e:
-                print("Error saving game: ", e)
+            self.persistence.update(Game, self.game_id, connection_time=self.connection_time)
 
         if self.playerLeftStatus == self.PlayerStatus.PLAYING and self.playerRightStatus == self.PlayerStatus.PLAYING:
-            if self.game_id is None or self.game is None:
+            if self.game_id is None:
                 print("Error: game_id or game not found on add_player")
                 raise self.GameNotFoundError
             #Test exit
             self.started = True
             self.status = self.GameStatus.PLAYING
-            self.game = Game.objects.get(id=self.game_id)
-            self.game.status = Game.GameStatus.IN_PROGRESS
-            self.game.save()
-            
+            self.persistence.update(Game, self.game_id, status=Game.GameStatus.IN_PROGRESS)
+
     def remove_player(self, user_id):
-        if self.game.status == Game.GameStatus.FINISHED:
-            self.status = self.GameStatus.FINISHED
+        # Keys held when disconnecting are released, logged so the replay
+        # releases them too
+        self.release_keys(user_id)
+        if self.input_log is not None:
+            self.input_log.connection(self.tick, user_id, False)
+
+        if self.status == self.GameStatus.FINISHED:
             self.playerLeftStatus = self.PlayerStatus.FINISHED
+            return
 
         if self.playerLeftId == user_id:
             self.status = self.GameStatus.PAUSED
@@ -145,29 +193,34 @@ class GameInstance():
             self.playerRightStatus = self.PlayerStatus.DISCONNECTED
 
         if self.playerLeftStatus == self.PlayerStatus.DISCONNECTED and self.playerRightStatus == self.PlayerStatus.DISCONNECTED:
-            try:
-                self.game.playerLeftScore = self.playerLeftScore
-                self.game.playerRightScore = self.playerRightScore
-                self.game.status = Game.GameStatus.FINISHED
-                self.game.winner = self.game.playerLeft
-                self.game.save()
-            except Exception as e:
-                print("Error saving game: ", e)
+            self.persistence.update(Game, self.game_id,
+                                    playerLeftScore=self.playerLeftScore,
+                                    playerRightScore=self.playerRightScore,
+                                    status=Game.GameStatus.FINISHED,
+                                    winner_id=self.playerLeftId)
+            self.persistence.flush()
 
-            self.next_tournament_game(self.playerRightId)
+            if self.tournament_id:
+                self.next_tournament_game(self.playerRightId)
 
             raise self.PlayersDisconnectedError
 
-        try:
-            self.game.playerLeftScore = self.playerLeftScore
-            self.game.playerRightScore = self.playerRightScore
-            self.game.status = Game.GameStatus.PAUSED
-            self.game.disconnection_time = timezone.now()
-            self.disconnection_time = self.game.disconnection_time
-            self.game.save()
-        except Exception as e:
-            print("Error saving game: ", e)
+        self.disconnection_time = timezone.now()
+        self.persistence.update(Game, self.game_id,
+                                playerLeftScore=self.playerLeftScore,
+                                playerRightScore=self.playerRightScore,
+                                status=Game.GameStatus.PAUSED,
+                                disconnection_time=self.disconnection_time)
 
+    def release_keys(self, user_id):
+        side = self.player_side(user_id)
+        if side is None:
+            return
+        attribute = 'paddleLeftDirection' if side == "left" else 'paddleRightDirection'
+        direction = getattr(self, attribute)
+        if direction and self.input_log is not None:
+            self.input_log.append(self.tick, user_id, "UP" if direction < 0 else "DOWN", "release")
+        setattr(self, attribute, 0)
 
     def player_side(self, user_id):
         if self.playerLeftId == user_id:
@@ -183,41 +236,71 @@ class GameInstance():
             return self.playerRightId
         return None
 
+    def set_rewind(self, user_id, steps):
+        if self.playerLeftId == user_id:
+            self.rewind_left = steps
+        elif self.playerRightId == user_id:
+            self.rewind_right = steps
+
+    def reset_paddle_history(self):
+        if self.paddle_history is not None:
+            self.paddle_history.clear()
+            self.paddle_history.append((self.paddle_left, self.paddle_right))
+
+    def record_paddles(self):
+        if self.paddle_history is not None:
+            self.paddle_history.append((self.paddle_left, self.paddle_right))
+
+    def rewound_paddles(self):
+        """
+        Positions of the paddles `rewind_left` and `rewind_right` steps ago,
+        or the oldest ones kept, None for a paddle that is not rewound.
+        """
+        history = self.paddle_history
+        if not history:
+            return None, None
+        last = len(history) - 1
+        left = history[max(last - self.rewind_left, 0)][0] if self.rewind_left else None
+        right = history[max(last - self.rewind_right, 0)][1] if self.rewind_right else None
+        return left, right
+
+    def serve_random(self):
+        # Derived from the points played, so restored games serve the same way
+        return random.Random(self.seed * 64 + self.playerLeftScore + self.playerRightScore)
+
+    def take_snapshot(self):
+        """
+        Replace the snapshot of the game by its current state. Only the
+        engine calls it, between two simulation steps.
+        """
+        self.snapshot = GameSnapshot(self.paddle_right, self.paddle_left, (self.dotX, self.dotY), self.tick)
+        return self.snapshot
+
     def restart_state(self):
+        rng = self.serve_random()
         self.dotX = 50
         self.dotY = 50
-        self.speedX = self.dx*random.choice([-1, 1]) * 0.5
-        self.speedY = self.dy*random.choice([-1, 1]) * 0.5
+        self.speedX = self.dx*rng.choice([-1, 1]) * 0.5
+        self.speedY = self.dy*rng.choice([-1, 1]) * 0.5
         #restart the position of the paddles
         self.paddle_right = 50
         self.paddle_left = 50
-        self.game_state['paddle_right'] = self.paddle_right
-        self.game_state['paddle_left'] = self.paddle_left
-        self.game_state['ball'] = [self.dotX, self.dotY]
         self.dotKicked = False
+        self.reset_paddle_history()
+        self.take_snapshot()
 
     def player_scored(self, player_side):
         if player_side == "left":
             self.playerLeftScore += 1
-            if (self.game):
-                self.game.playerLeftScore = self.playerLeftScore
         elif player_side == "right":
             self.playerRightScore += 1
-            if (self.game):
-                self.game.playerRightScore = self.playerRightScore
+        self.persistence.update(Game, self.game_id,
+                                playerLeftScore=self.playerLeftScore,
+                                playerRightScore=self.playerRightScore)
         if self.playerLeftScore >= 5 or self.playerRightScore >= 5:
             print("Player won the game")
-            try:
-                winner_id = self.side_player(player_side)
-                winner = User.objects.get(id=winner_id)
-            except:
-                winner = None
-            if (self.game):
-                self.game.winner = winner
             self.game_finished(self.side_player(player_side))
-            if (self.game):
-                self.game.save()
-            if (self.game.tournament):
+            if self.tournament_id:
                 loser_id = self.side_player("left" if player_side == "right" else "right")
                 self.next_tournament_game(loser_id)
 
@@ -227,77 +310,112 @@ class GameInstance():
         elif self.playerRightStatus == self.PlayerStatus.DISCONNECTED:
             self.game_finished(self.playerLeftId)
 
+    def game_not_started(self):
+        # Only one of the players showed up
+        if self.tournament_id:
+            if self.playerLeftStatus == self.PlayerStatus.PLAYING:
+                winner_id, loser_id = self.playerLeftId, self.playerRightId
+            else:
+                winner_id, loser_id = self.playerRightId, self.playerLeftId
+            self.game_finished(winner_id)
+            self.next_tournament_game(loser_id)
+        else:
+            self.game_not_contested()
+
+    def send(self, event):
+        if self.sender is not None:
+            self.sender(self.group_name, event)
+        else:
+            async_to_sync(self.channel_layer.group_send)(self.group_name, event)
+
+    def invite_expired(self):
+        self.status = self.GameStatus.FINISHED
+        self.send(end_event({"end": "Invite expired", "winner": None}))
+        self.persistence.submit(cancel_pending_invite, self.invite_id)
+
     def game_not_contested(self):
         self.status = self.GameStatus.FINISHED
-        async_to_sync(self.channel_layer.group_send)(
-            self.group_name, {"type": "game_update", "end_dict": {"end": "Game not contested", "winner": None}}
-        )
-        try:
-            self.game.status = Game.GameStatus.FINISHED
-            self.game.winner = None
-            self.game.save()
-        except:
-            pass
+        self.send(end_event({"end": "Game not contested", "winner": None}))
+        self.persistence.update(Game, self.game_id, status=Game.GameStatus.FINISHED, winner_id=None)
+        self.persistence.flush()
 
     def game_finished(self, winner_id):
         self.status = self.GameStatus.FINISHED
-
+        self.winner_id = winner_id
 
         try:
-            if self.game.tournament:
-                tournament_id = self.game.tournament.id
+            if self.tournament_id:
+                self.send(end_event({"end": "Game finished", "winner": winner_id, "tournament_id": self.tournament_id}))
             else:
-                tournament_id = None
-            if tournament_id:
-                async_to_sync(self.channel_layer.group_send)(
-                    self.group_name, {"type": "game_update", "end_dict": {"end": "Game finished", "winner": winner_id, "tournament_id": tournament_id}}
-                )
-            else:
-                async_to_sync(self.channel_layer.group_send)(
-                    self.group_name, {"type": "game_update", "end_dict": {"end": "Game finished", "winner": winner_id}}
-                )
+                self.send(end_event({"end": "Game finished", "winner": winner_id}))
         except Exception as e:
             print("Error sending game update: ", e)
-        try:
-            self.game.status = Game.GameStatus.FINISHED
-            self.game.winner = User.objects.get(id=winner_id)
-            self.game.playerLeftScore = self.playerLeftScore
-            self.game.playerRightScore = self.playerRightScore
-            self.game.finished_at = timezone.now()
-            self.game.save()
-        except:
-            pass
+
+        self.persistence.update(Game, self.game_id,
+                                status=Game.GameStatus.FINISHED,
+                                winner_id=winner_id,
+                                playerLeftScore=self.playerLeftScore,
+                                playerRightScore=self.playerRightScore,
+                                finished_at=timezone.now())
+        self.persistence.flush()
+
+    def release(self):
+        pass
+
+    # State saved by the checkpoints, in this order
+    CHECKPOINT_FIELDS = (
+        'game_id', 'invite_id', 'tournament_id', 'status',
+        'playerLeftStatus', 'playerRightStatus', 'playerLeftScore', 'playerRightScore',
+        'dx', 'dy', 'dotX', 'dotY', 'speedX', 'speedY', 'paddle_left', 'paddle_right',
+        'paddleLeftDirection', 'paddleRightDirection', 'started', 'dotKicked', 'tick', 'seed',
+        'rewind_left', 'rewind_right',
+    )
+    CHECKPOINT_TIMES = ('disconnection_time', 'connection_time')
+
+    def checkpoint(self):
+        state = [getattr(self, field) for field in self.CHECKPOINT_FIELDS]
+        for field in self.CHECKPOINT_TIMES:
+            value = getattr(self, field)
+            state.append(value.timestamp() if value is not None else None)
+        return state
+
+    def restore(self, state):
+        for field, value in zip(self.CHECKPOINT_FIELDS, state):
+            setattr(self, field, value)
+        for field, value in zip(self.CHECKPOINT_TIMES, state[len(self.CHECKPOINT_FIELDS):]):
+            setattr(self, field, datetime.fromtimestamp(value, tz=dt_timezone.utc) if value is not None else None)
+        self.reset_paddle_history()
+        self.take_snapshot()
+        self.keyframe_pending = True
 
     def end_game(self):
-        try:
-            print("Ending game")
-            self.game.status = Game.GameStatus.FINISHED
-            self.game.playerLeftScore = self.playerLeftScore
-            self.game.playerRightScore = self.playerRightScore
-            self.game.save()
-        except:
-            pass
+        print("Ending game")
+        self.persistence.update(Game, self.game_id,
+                                status=Game.GameStatus.FINISHED,
+                                playerLeftScore=self.playerLeftScore,
+                                playerRightScore=self.playerRightScore)
+        self.persistence.flush()
 
     def next_tournament_game(self, loser_id):
-        try:
-            loser = User.objects.get(id=loser_id)
-            user_tournament = UserTournament.objects.get(user=loser, tournament=self.game.tournament)
-            user_tournament.status = UserTournament.UserStatus.ELIMINATED
-            user_tournament.save()
-        except Exception as e:
-            print("Error saving user tournament: ", e)
+        # Runs on the persistence thread once the result of this game is saved
+        self.persistence.submit(advance_tournament, self.tournament_id, loser_id)
+        self.persistence.flush()
 
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': settings.MICROSERVICE_API_TOKEN
-        }
+class GameEngine(threading.Thread):
 
-        new_game = requests.post(settings.GAME_SERVICE_HOST_INTERNAL +
-            '/tournament/nextgame/', headers=headers, json={
-                'tournament_id': self.game.tournament.id
-            }, verify=False)
+    # Paddle movement per step relative to the game dx, and paddle limits
+    PADDLE_SPEED = 0.5
+    PADDLE_MIN = 16
+    PADDLE_MAX = 84
+    # Tick rate the speeds of the ball and the paddles are given for
+    SPEED_TICK_RATE = 60
+    # Seconds between two logs of the steps dropped by the scheduler
+    OVERRUN_LOG_INTERVAL = 1.0
 
-class GameEngine(threading.Thread):
+    class Timeout():
+        DISCONNECTION = "disconnection"
+        START = "start"
+        INVITE = "invite"
 
     playerCount = 0
 
@@ -309,66 +427,430 @@ class GameEngine(threading.Thread):
         self.channel_name = channel_name
         self.channel_layer = get_channel_layer()
         self.games = {}
+        self.stopped = threading.Event()
+        self.persistence = GamePersistence(settings.GAME_PERSISTENCE_INTERVAL)
+        # Whatever is still queued is written when the worker exits
+        atexit.register(self.persistence.stop)
+        self.scheduler = TickScheduler(settings.GAME_TICK_RATE, settings.GAME_MAX_CATCHUP_STEPS)
+        # Movement of a step, so the games run at the same speed at any tick rate
+        self.step_scale = self.SPEED_TICK_RATE / settings.GAME_TICK_RATE
+        # The state is simulated every tick but only sent every `send_interval` ticks
+        self.send_interval = max(1, round(settings.GAME_TICK_RATE / max(settings.GAME_SEND_RATE, 1)))
+        self.heartbeat_ticks = round(settings.GAME_IDLE_HEARTBEAT * settings.GAME_TICK_RATE)
+        self.keyframe_interval = settings.GAME_KEYFRAME_INTERVAL
+        # Server time of the current tick, stamped on its frames
+        self.tick_time = server_time()
+
+        self.metrics = EngineMetrics()
+        # The overruns are counted by the metrics, and only logged every
+        # OVERRUN_LOG_INTERVAL seconds
+        self.next_overrun_log = 0
+        self.logged_overruns = 0
+        self.logged_dropped_steps = 0
+        # Latest network quality of the game sockets of the shard, by user
+        self.network = {}
+        self.publisher = None
+        if settings.GAME_METRICS_INTERVAL:
+            self.publisher = MetricsPublisher(self, settings.GAME_METRICS_INTERVAL)
+
+        # Binary recording of the frames of every game
+        self.recorder = None
+        if settings.GAME_RECORDING_DIR:
+            self.recorder = RecordingWriter(settings.GAME_RECORDING_DIR)
+
+        # Spectators of each game, fed at a lower rate from another thread
+        self.spectators = {}
+        self.fanout = SpectatorFanout()
+        self.spectator_interval = max(1, round(settings.GAME_TICK_RATE / max(settings.GAME_SPECTATOR_SEND_RATE, 1)))
+
+        # Paddle inputs are applied at the start of every tick
+        self.inputs = InputMailbox()
+        # Control messages of the consumers, run at the start of the next
+        # tick so the games are only changed by the thread of the engine
+        self.control_lock = threading.Lock()
+        self.control_jobs = []
+
+        # Steps a paddle can be rewound for the hit tests of a lagging player
+        self.lag_window = round(settings.GAME_LAG_COMPENSATION * settings.GAME_TICK_RATE)
+        # The clients render two frame intervals behind the latest frame
+        self.interpolation_ticks = 2 * self.send_interval
+
+        # Disconnection forfeits and expiry of the games nobody joined
+        self.deadlines = DeadlineHeap()
+
+        # Games are checkpointed to Redis to survive a restart of the worker
+        self.checkpoints = None
+        self.next_checkpoint = 0
+        if settings.GAME_CHECKPOINT_INTERVAL:
+            self.checkpoints = CheckpointStore(self.channel_name)
+
+        # Optional vectorized physics for all the games of the worker
+        self.batch = None
+        if settings.GAME_ENGINE_BATCH_PHYSICS:
+            from .batch import BatchPhysics
+            self.batch = BatchPhysics(self.PADDLE_MIN, self.PADDLE_MAX, self.step_scale,
+                                      history_size=self.lag_window + 1)
+
+    def stop(self):
+        self.stopped.set()
 
     def run(self) -> None:
-        while True:
+        self.start_services()
+        while not self.stopped.is_set():
+            self.run_tick(self.scheduler.wait())
+
+    def start_services(self):
+        self.persistence.start()
+        self.fanout.start()
+        if self.publisher is not None:
+            self.publisher.start()
+        if self.recorder is not None:
+            self.recorder.start()
+        if self.checkpoints is not None:
+            self.checkpoints.start()
+            self.restore_games()
+
+    def run_tick(self, steps):
+        if steps == 0:
+            return
+        start = time.perf_counter()
+        self.tick(steps)
+        self.metrics.observe_tick(time.perf_counter() - start, self.scheduler)
+        if self.scheduler.dropped_steps:
+            self.log_overruns()
+
+        if self.checkpoints is not None and time.monotonic() >= self.next_checkpoint:
+            self.next_checkpoint = time.monotonic() + settings.GAME_CHECKPOINT_INTERVAL
             for game in list(self.games.values()):
-                if game.status == game.GameStatus.PAUSED and game.disconnection_time:
-                    if (timezone.now() - game.disconnection_time).seconds > 30:
-                        game.game_winned_disconnected()
-                if game.status != game.GameStatus.PLAYING:
+                self.checkpoint_game(game)
+
+    def log_overruns(self):
+        now = time.monotonic()
+        if now < self.next_overrun_log:
+            return
+        metrics = self.metrics
+        print("Engine overrun: %d ticks late, %d steps dropped since the last report, tick period %.4fs, overrun %.4fs" % (
+            metrics.overruns - self.logged_overruns, metrics.dropped_steps - self.logged_dropped_steps,
+            self.scheduler.tick_period, self.scheduler.overrun))
+        self.next_overrun_log = now + self.OVERRUN_LOG_INTERVAL
+        self.logged_overruns = metrics.overruns
+        self.logged_dropped_steps = metrics.dropped_steps
+
+    def checkpoint_game(self, game):
+        self.flush_input_log(game)
+        if self.checkpoints is None:
+            return
+        if game.status == game.GameStatus.FINISHED:
+            self.checkpoints.delete(game.group_name)
+        else:
+            self.checkpoints.save(game.group_name, game.checkpoint())
+
+    def restore_games(self):
+        """
+        Resume the games checkpointed by the previous worker of this shard.
+        """
+        for group_name, state in self.checkpoints.load().items():
+            if group_name in self.games:
+                continue
+            try:
+                game = self.new_game(group_name, state[GameInstance.CHECKPOINT_FIELDS.index('seed')])
+                game.restore(state)
+            except Exception as e:
+                print("Error restoring game %s: " % group_name, e)
+                self.checkpoints.delete(group_name)
+                continue
+            self.games[group_name] = game
+            self.schedule_timeout(game)
+            print("Restored game %s" % group_name)
+
+    def schedule_timeout(self, game):
+        """
+        Set the deadline of a game that is waiting for its players, or for
+        one of them to reconnect. It replaces the previous one of the game.
+        """
+        if game.status == game.GameStatus.PAUSED:
+            delay = settings.GAME_DISCONNECTION_TIMEOUT
+            if game.disconnection_time is not None:
+                # The disconnection may have been recorded by a previous worker
+                delay -= (timezone.now() - game.disconnection_time).total_seconds()
+            self.deadlines.schedule(game.group_name, self.Timeout.DISCONNECTION, delay)
+        elif game.status == game.GameStatus.WAITING:
+            if game.game_id is None:
+                self.deadlines.schedule(game.group_name, self.Timeout.INVITE, settings.GAME_INVITE_TIMEOUT)
+            else:
+                self.deadlines.schedule(game.group_name, self.Timeout.START, settings.GAME_START_TIMEOUT)
+
+    def expire_timeouts(self):
+        for group_name, kind in self.deadlines.pop_expired():
+            game = self.games.get(group_name)
+            if game is None:
+                continue
+            # The deadlines are not cancelled when the players come back, so
+            # the state of the game is checked again
+            if kind == self.Timeout.DISCONNECTION:
+                if game.status != game.GameStatus.PAUSED:
                     continue
+                if game.PlayerStatus.WAITING in (game.playerLeftStatus, game.playerRightStatus):
+                    # Paused before the other player ever joined
+                    game.game_not_started()
+                    self.discard_game(group_name)
+                else:
+                    game.game_winned_disconnected()
+            elif kind == self.Timeout.START:
+                if game.status == game.GameStatus.WAITING:
+                    game.game_not_started()
+                    self.discard_game(group_name)
+            elif kind == self.Timeout.INVITE:
+                if game.status == game.GameStatus.WAITING and game.game_id is None:
+                    game.invite_expired()
+                    self.discard_game(group_name)
+
+    def submit(self, job, *args):
+        """
+        Run `job` with `args` on the engine before its next tick, from any
+        thread.
+        """
+        with self.control_lock:
+            self.control_jobs.append((job, args))
+
+    def run_control_jobs(self):
+        with self.control_lock:
+            jobs, self.control_jobs = self.control_jobs, []
+        for job, args in jobs:
+            try:
+                job(*args)
+            except Exception as e:
+                print("Error running %s: " % job.__name__, e)
+
+    def send_group(self, group_name, event):
+        start = time.perf_counter()
+        async_to_sync(self.channel_layer.group_send)(group_name, event)
+        self.metrics.group_send_latency.observe(time.perf_counter() - start)
 
+    def tick(self, steps):
+        self.tick_time = server_time()
+        self.run_control_jobs()
+        self.expire_timeouts()
+        self.apply_inputs()
+        if self.batch is not None:
+            self.batch_tick(steps)
+            self.broadcast_spectators()
+            return
+
+        for game in list(self.games.values()):
+            if game.status != game.GameStatus.PLAYING:
+                continue
+
+            # Run every pending simulation step, but broadcast only once
+            for _ in range(steps):
+                game.tick += 1
+                self.move_paddles(game)
                 self.update_ball_position(game.group_name)  # Update ball position
-                self.broadcast_state(game.group_name, game.game_state)  # Broadcast game state
-            time.sleep(0.016)
+            game.take_snapshot()
+            self.broadcast_state(game)  # Broadcast game state
+        self.broadcast_spectators()
 
-    def broadcast_state(self, group_name, game_state):
-        async_to_sync(self.channel_layer.group_send)(
-            group_name, {"type": "game_update", "game_dict": game_state}
-        )
+    def batch_tick(self, steps):
+        batch = self.batch
+        for _ in range(steps):
+            # Goals are scored on the tick of their step, as in the scalar path
+            left_goals, right_goals = batch.step()
+            for slot in left_goals:
+                self.goal_scored(batch.games[slot], "right")
+            for slot in right_goals:
+                self.goal_scored(batch.games[slot], "left")
 
-    def add_player(self, group_name, user_id, game_id, invite_id):
-        if group_name not in self.games:
-            self.games[group_name] = GameInstance(group_name)
+        # The games to send and what changed are found on the arrays, the
+        # snapshots and the frames are only made for the games that send one
+        games, tick_time, send_group = batch.games, self.tick_time, self.send_group
+        recording = self.recorder is not None
+        for slot, keyframe, ball, left, right, x, y, paddle_left, paddle_right, tick in zip(
+                *batch.take_frames(self.send_interval, self.keyframe_interval, self.heartbeat_ticks)):
+            game = games[slot]
+            snapshot = game.snapshot = GameSnapshot(paddle_right, paddle_left, (x, y), tick)
+            if keyframe:
+                event = state_event("game_dict", snapshot._asdict(), snapshot, tick_time)
+            else:
+                delta = {}
+                if right:
+                    delta["paddle_right"] = paddle_right
+                if left:
+                    delta["paddle_left"] = paddle_left
+                if ball:
+                    delta["ball"] = snapshot.ball
+                event = state_event("game_delta", delta, snapshot, tick_time)
+            if recording:
+                self.record_frame(game)
+            send_group(game.group_name, event)
+
+    def new_game(self, group_name, seed=None):
+        if self.batch is not None:
+            from .batch import BatchGameInstance
+            game = BatchGameInstance(group_name, self.persistence, self.batch, self.PADDLE_SPEED * self.step_scale, seed)
+        else:
+            game = GameInstance(group_name, self.persistence, seed)
+            if self.lag_window:
+                game.paddle_history = deque(maxlen=self.lag_window + 1)
+                game.reset_paddle_history()
+        game.sender = self.send_group
+        if settings.GAME_INPUT_LOG_DIR:
+            game.input_log = InputLog(input_log_path(settings.GAME_INPUT_LOG_DIR, group_name, game.seed),
+                                      settings.GAME_TICK_RATE, self.lag_window)
+        return game
+
+    def record_frame(self, game, events=0):
+        if self.recorder is None or game.game_id is None:
+            return
+        if game.recording is None:
+            game.recording = self.recorder.open(game.game_id)
+        snapshot = game.snapshot
+        ball = snapshot.ball
+        game.recording.record(snapshot.tick, ball[0], ball[1], snapshot.paddle_left, snapshot.paddle_right, events)
+
+    def close_recording(self, game):
+        if game.recording is None:
+            return
+        if game.status == game.GameStatus.FINISHED:
+            self.record_frame(game, EVENT_FINISHED)
+        game.recording.close()
+        game.recording = None
+
+    def flush_input_log(self, game):
+        if game.input_log is None:
+            return
+        lines = game.input_log.take(game, game.status == game.GameStatus.FINISHED)
+        if lines:
+            self.persistence.submit(append_input_log, game.input_log.path, lines)
+
+    def discard_game(self, group_name):
+        game = self.games.pop(group_name, None)
+        if game is not None:
+            self.flush_input_log(game)
+            self.close_recording(game)
+            if group_name in self.spectators:
+                self.fanout.publish_end(group_name, game.winner_id, game.playerLeftScore, game.playerRightScore)
+            game.release()
+        self.deadlines.cancel(group_name)
+        if self.checkpoints is not None:
+            self.checkpoints.delete(group_name)
+
+    def broadcast_state(self, game):
+        """
+        Send the fields of the snapshot of the game that changed since the
+        last broadcast, or the full snapshot as a keyframe when someone
+        (re)joined or every GAME_KEYFRAME_INTERVAL ticks.
+
+        Broadcasts happen at most every `send_interval` ticks. A game where
+        nothing moved, like between two points, sends nothing but a keyframe
+        every GAME_IDLE_HEARTBEAT seconds.
+        """
+        snapshot = game.snapshot
+        tick = snapshot.tick
+        keyframe_pending = game.keyframe_pending
+        since_sent = tick - game.last_sent_tick
+        if not keyframe_pending and since_sent < self.send_interval:
+            return
+        delta = snapshot_delta(snapshot, game.sent_snapshot)
+        if delta:
+            keyframe = tick - game.last_keyframe_tick >= self.keyframe_interval
+        else:
+            keyframe = self.heartbeat_ticks and since_sent >= self.heartbeat_ticks
+        if keyframe_pending or keyframe:
+            game.keyframe_pending = False
+            game.last_keyframe_tick = tick
+            event = state_event("game_dict", snapshot._asdict(), snapshot, self.tick_time)
+        elif delta:
+            event = state_event("game_delta", delta, snapshot, self.tick_time)
+        else:
+            return
+        game.sent_snapshot = snapshot
+        game.last_sent_tick = tick
+        self.record_frame(game)
+        self.send_group(game.group_name, event)
+
+    def broadcast_spectators(self):
+        """
+        Send the full state of the watched games every `spectator_interval`
+        ticks, serialized once for all the spectators of a game.
+        """
+        for group_name in list(self.spectators):
+            game = self.games.get(group_name)
+            if game is None:
+                continue
+            if not game.spectator_pending and game.tick - game.last_spectator_tick < self.spectator_interval:
+                continue
+            game.spectator_pending = False
+            game.last_spectator_tick = game.tick
+            if self.batch is not None:
+                # The batch path only takes the snapshots it broadcasts
+                game.take_snapshot()
+            self.fanout.publish_state(group_name, game.snapshot, game.playerLeftScore, game.playerRightScore,
+                                      self.tick_time)
+
+    def spectator_join(self, group_name):
+        self.spectators[group_name] = self.spectators.get(group_name, 0) + 1
+        game = self.games.get(group_name)
+        if game is not None:
+            game.spectator_pending = True
+
+    def spectator_leave(self, group_name):
+        count = self.spectators.get(group_name, 0) - 1
+        if count > 0:
+            self.spectators[group_name] = count
+        else:
+            self.spectators.pop(group_name, None)
+
+    def player_network(self, user_id, network):
+        if user_id is None or not network or network.get("rtt") is None:
+            return
+        self.network[user_id] = network
+        self.metrics.client_rtt.observe(network["rtt"])
+        self.metrics.client_jitter.observe(network["jitter"])
+
+    def add_player(self, group_name, user_id, game_id, invite_id, tournament_id=None):
+        created = group_name not in self.games
+        if created:
+            self.games[group_name] = self.new_game(group_name)
         try:
-            self.games[group_name].add_player(user_id, game_id, invite_id)
+            game = self.games[group_name]
+            game.add_player(user_id, game_id, invite_id, tournament_id)
+            # A player coming back to a paused game may still be alone in it,
+            # the deadline of the missing player is armed again
+            if created or game.status == game.GameStatus.PAUSED:
+                self.schedule_timeout(game)
         except Exception as e:
             print("Error adding player: ", e)
-            async_to_sync(self.channel_layer.group_send)(
-                group_name, {"type": "game_update", "end_dict": {"error": "Error adding player"}}
-            )
+            self.send_group(group_name, end_event({"error": "Error adding player"}))
             self.games[group_name].end_game()
-            self.games.pop(group_name)
+            self.discard_game(group_name)
 
 
     def remove_player(self, group_name, user_id):
+        self.network.pop(user_id, None)
         if group_name not in self.games:
             return
         try:
             self.games[group_name].remove_player(user_id)
+            if self.games[group_name].status == GameInstance.GameStatus.PAUSED:
+                self.schedule_timeout(self.games[group_name])
         except GameInstance.PlayersDisconnectedError as e:
             print("Error removing player: ", e)
-            async_to_sync(self.channel_layer.group_send)(
-                group_name, {"type": "game_update", "end_dict": {"error": "Error removing player"}}
-            )
+            self.send_group(group_name, end_event({"error": "Error removing player"}))
             self.games[group_name].end_game()
-            self.games.pop(group_name)
+            self.discard_game(group_name)
             # if self.games[group_name].game.tournament:
             #     send_tournament_players_update_notification(self.games[group_name].tournament)
         except Exception as e:
             print("Error removing player: ", e)
-            async_to_sync(self.channel_layer.group_send)(
-                group_name, {"type": "game_update", "end_dict": {"error": "Error removing player"}}
-            )
+            self.send_group(group_name, end_event({"error": "Error removing player"}))
             self.games[group_name].end_game()
-            self.games.pop(group_name)
+            self.discard_game(group_name)
 
     def end_game(self, group_name):
         if group_name not in self.games:
             return
         self.games[group_name].end_game()
-        self.games.pop(group_name)
+        self.discard_game(group_name)
 
     def restart_state(self, group_name):
         game = self.games[group_name]
@@ -388,60 +870,211 @@ class GameEngine(threading.Thread):
 
         if not game.dotKicked:
             return
-        # loosing because of coliision with the left wall
-        if (game.dotX + game.speedX - 0.5) < 1:
-            game.dotKicked = False
-            game.started = False
-            game.player_scored("right")
-            async_to_sync(self.channel_layer.group_send)(
-                game.group_name, {"type": "game_update", "score_dict": {"left":
-                                                                        game.playerLeftScore,
-                                                                        "right":
-                                                                        game.playerRightScore}}
-            )
-        # loosing because of coliision with the right wall
-        elif (game.dotX + game.speedX + 0.5) > 99:
-            game.dotKicked = False
-            game.started = False
-            game.player_scored("left")
-            async_to_sync(self.channel_layer.group_send)(
-                game.group_name, {"type": "game_update", "score_dict": {"left": game.playerLeftScore, "right":
-                                                                        game.playerRightScore}}
-            )
-        #bouncing at the top
-        elif (game.dotY + game.speedY - 0.5) < 1:
-            game.speedY = -game.speedY
-            game.dotY += game.speedY
-        # bouncing at the bottom
-        elif (game.dotY + game.speedY + 0.5) > 99:
-            game.speedY = -game.speedY
-            game.dotY += game.speedY
-        # bouncing at the right paddle
-        elif (game.dotX + game.speedX + 0.5) > 93 and (game.paddle_right - 15) < game.dotY < (game.paddle_right + 15):
-            game.speedX = -game.speedX
-            game.dotX += game.speedX
-        # bouncing at the left paddle
-        elif (game.dotX + game.speedX - 0.5) < 7 and (game.paddle_left - 15) < game.dotY < (game.paddle_left + 15):
-            game.speedX = -game.speedX
-            game.dotX += game.speedX
-        #regular movement
+        rewound_left, rewound_right = game.rewound_paddles()
+        game.dotX, game.dotY, game.speedX, game.speedY, scorer = sweep_ball(
+            game.dotX, game.dotY, game.speedX, game.speedY,
+            game.paddle_left, game.paddle_right, self.step_scale, rewound_left, rewound_right)
+        if scorer is not None:
+            self.goal_scored(game, scorer)
+
+    def goal_scored(self, game, player_side):
+        game.dotKicked = False
+        game.started = False
+        game.player_scored(player_side)
+        game.take_snapshot()
+        self.record_frame(game, EVENT_GOAL_LEFT if player_side == "left" else EVENT_GOAL_RIGHT)
+        self.checkpoint_game(game)
+        self.send_group(game.group_name, score_event(game.playerLeftScore, game.playerRightScore))
+
+    def apply_inputs(self):
+        inputs, received = self.inputs.drain()
+        self.metrics.inputs += received
+        for (group_name, user_id, action), (state, client_tick) in inputs.items():
+            game = self.games.get(group_name)
+            if game is not None:
+                self.apply_input(game, user_id, action, state, client_tick)
+
+    def apply_input(self, game, user_id, action, state, client_tick=None):
+        if client_tick is not None and self.lag_window:
+            # The player pressed the key while looking at the frame of
+            # `client_tick`, their paddle is hit tested that far back, but
+            # never further than their connection explains
+            client_tick = max(client_tick, game.tick - self.rewind_limit(user_id))
+            game.set_rewind(user_id, min(max(game.tick - client_tick, 0), self.lag_window))
+        if game.input_log is not None:
+            game.input_log.append(game.tick, user_id, action, state, client_tick)
+        if state is not None:
+            self.set_paddle_input(user_id, action, state == "press", game.group_name)
+        else:
+            self.update_paddle_position(user_id, action, game.group_name)
+        if action == "ENTER":
+            self.kick_dot(game.group_name)
+
+    def rewind_limit(self, user_id):
+        """
+        Steps the paddle of a player can be rewound: the measured round trip
+        of their socket and the interpolation delay of the client. Only the
+        interpolation delay until the first measure.
+        """
+        network = self.network.get(user_id)
+        rtt = network["srtt"] + network["jitter"] if network else 0.0
+        return min(math.ceil(rtt * settings.GAME_TICK_RATE) + self.interpolation_ticks, self.lag_window)
+
+    def set_paddle_input(self, player, action, pressed, group_name):
+        """
+        Press/release input model, the paddles are moved on every step by
+        move_paddles while a key is held.
+        """
+        game = self.games.get(group_name)
+        if game is None:
+            return
+        player_side = game.player_side(player)
+        if player_side is None:
+            return
+        if action == "W" or action == "UP":
+            direction = -1
+        elif action == "S" or action == "DOWN":
+            direction = 1
         else:
-            game.dotY += game.speedY
-            game.dotX += game.speedX
-        game.game_state['ball'] = [game.dotX, game.dotY] 
+            return
+
+        attribute = 'paddleLeftDirection' if player_side == "left" else 'paddleRightDirection'
+        if pressed:
+            setattr(game, attribute, direction)
+        elif getattr(game, attribute) == direction:
+            setattr(game, attribute, 0)
+
+    def move_paddles(self, game):
+        step = game.dx * self.PADDLE_SPEED * self.step_scale
+        if game.paddleLeftDirection:
+            game.paddle_left = min(max(game.paddle_left + game.paddleLeftDirection * step, self.PADDLE_MIN), self.PADDLE_MAX)
+        if game.paddleRightDirection:
+            game.paddle_right = min(max(game.paddle_right + game.paddleRightDirection * step, self.PADDLE_MIN), self.PADDLE_MAX)
+        game.record_paddles()
 
     def update_paddle_position(self, player, action, group_name):
         game = self.games[group_name]
         if game.status != game.GameStatus.PLAYING:
             return
         player_side = game.player_side(player)
+        if player_side is None:
+            return
+        attribute = 'paddle_' + player_side
+        paddle = getattr(game, attribute)
         if action == "W" or action == "UP":
-            if game.game_state['paddle_'+player_side] - game.dx-15 < 1:
+            if paddle - game.dx-15 < 1:
                 return
-            game.game_state['paddle_'+player_side] -= game.dx
+            setattr(game, attribute, paddle - game.dx)
         elif action == "S" or action == "DOWN":
-            if game.game_state['paddle_'+player_side] + game.dx + 15 > 99:
+            if paddle + game.dx + 15 > 99:
+                return
+            setattr(game, attribute, paddle + game.dx)
+
+
+class AsyncGameEngine(GameEngine):
+    """
+    Engine run as a task of the event loop of the worker instead of its own
+    thread. The consumers of the shard call it from the same loop, so the
+    control messages, the inputs and the ticks never cross threads or
+    contend for the GIL.
+
+    The messages of a group are queued and sent in order by a task of the
+    group, and the spectator frames by the task of the fanout. The tick loop
+    never waits for them, so a slow group delays its own frames only, not
+    the simulation or the frames of the other games.
+    """
+
+    # Events queued for a group that cannot keep up beyond which its frames
+    # are dropped, the next one is a keyframe
+    OUTBOX_LIMIT = 64
+
+    def __init__(self, channel_name, **kwargs):
+        super().__init__(channel_name, **kwargs)
+        self.task = None
+        # group -> events not sent yet, and the task sending them
+        self.outbox = {}
+        self.senders = {}
+        self.fanout = LoopFanout()
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run_async())
+        self.task.add_done_callback(self.task_done)
+
+    def task_done(self, task):
+        # Nobody awaits the task before the worker exits
+        if not task.cancelled() and task.exception() is not None:
+            print("Error: the game engine stopped: ", repr(task.exception()))
+
+    async def run_async(self):
+        self.start_services()
+        while not self.stopped.is_set():
+            steps = await self.scheduler.wait_async()
+            try:
+                # Messages sent by the consumers since the last tick go out with it
+                self.run_tick(steps)
+            except Exception as e:
+                # The other games of the shard keep running
+                print("Error running the engine tick: ", e)
+                traceback.print_exc()
+        if self.senders:
+            await asyncio.gather(*self.senders.values())
+
+    def send_group(self, group_name, event):
+        events = self.outbox.get(group_name)
+        if events is None:
+            events = self.outbox[group_name] = deque()
+            self.senders[group_name] = asyncio.ensure_future(self.send_events(group_name, events))
+        elif len(events) >= self.OUTBOX_LIMIT:
+            self.drop_frames(group_name, events)
+            if event["type"] == "game_frame":
                 return
-            game.game_state['paddle_'+player_side] += game.dx
-        game.paddle_right = game.game_state['paddle_right']
-        game.paddle_left = game.game_state['paddle_left']
+        events.append(event)
+
+    def drop_frames(self, group_name, events):
+        kept = [event for event in events if event["type"] != "game_frame"]
+        events.clear()
+        events.extend(kept)
+        game = self.games.get(group_name)
+        if game is not None:
+            game.keyframe_pending = True
+
+    async def send_events(self, group_name, events):
+        # Sent once the tick returns to the loop, until the queue of the
+        # group is empty
+        try:
+            while events:
+                event = events.popleft()
+                start = time.perf_counter()
+                try:
+                    await self.channel_layer.group_send(group_name, event)
+                except Exception as e:
+                    print("Error sending game update: ", e)
+                self.metrics.group_send_latency.observe(time.perf_counter() - start)
+        finally:
+            del self.outbox[group_name]
+            del self.senders[group_name]
+
+
+# Engines run by this worker process, shared by the consumers of the control
+# and input channels of a shard
+engines = {}
+engines_lock = threading.Lock()
+
+
+def get_engine(shard):
+    """
+    Engine of the shard, started on first use. The asyncio engine has to be
+    created from the event loop of the worker.
+    """
+    with engines_lock:
+        engine = engines.get(shard)
+        if engine is None:
+            engine_class = AsyncGameEngine if settings.GAME_ENGINE_ASYNC else GameEngine
+            engine = engine_class(engine_channel_name(shard))
+            engine.start()
+            engines[shard] = engine
+
+            # Exit cleanly on "docker stop" so the pending game updates are saved
+            if threading.current_thread() is threading.main_thread():
+                signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        return engine
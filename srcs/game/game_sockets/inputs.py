@@ -0,0 +1,35 @@
+import threading
+
+
+class InputMailbox():
+    """
+    Paddle inputs received by the worker, waiting for the next tick.
+
+    Only the latest input of each player for each key is kept: a press
+    followed by a release before the tick is a release. The engine takes
+    everything at once at the start of a tick with drain().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (group_name, user_id, action) -> (state, client tick)
+        self.inputs = {}
+        self.received = 0
+
+    def put(self, group_name, user_id, action, state, client_tick=None):
+        key = (group_name, user_id, action)
+        with self.lock:
+            # Moved to the end so the inputs are applied in the order of
+            # their latest change
+            self.inputs.pop(key, None)
+            self.inputs[key] = (state, client_tick)
+            self.received += 1
+
+    def drain(self):
+        """
+        Return the pending inputs and the number of messages they replace.
+        """
+        with self.lock:
+            inputs, self.inputs = self.inputs, {}
+            received, self.received = self.received, 0
+        return inputs, received
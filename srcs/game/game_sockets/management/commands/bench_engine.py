@@ -0,0 +1,227 @@
+import asyncio
+import json
+import threading
+import time
+import tracemalloc
+
+from asgiref.sync import async_to_sync
+from channels.layers import DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer, channel_layers
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from game_sockets.engine import AsyncGameEngine, GameEngine
+from game_sockets.metrics import percentiles
+from game_sockets.persistence import NullPersistence
+
+
+class BenchChannelLayer(InMemoryChannelLayer):
+    """
+    In-memory channel layer that times every group_send of the engine.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.tick_started = None
+        self.send_latencies = []
+        self.broadcast_lags = []
+        self.group_sends = 0
+        self.received = 0
+
+    async def group_send(self, group, message):
+        start = time.perf_counter()
+        await super().group_send(group, message)
+        end = time.perf_counter()
+        self.group_sends += 1
+        self.send_latencies.append(end - start)
+        # How long after the start of the tick the game state left the engine
+        if self.tick_started is not None:
+            self.broadcast_lags.append(end - self.tick_started)
+
+    def drain(self):
+        """
+        Empty the player channels, as the websocket consumers would.
+        """
+        for queue in list(self.channels.values()):
+            while not queue.empty():
+                queue.get_nowait()
+                self.received += 1
+
+
+class BenchEngine(GameEngine):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.persistence = NullPersistence()
+        self.publisher = None
+        self.checkpoints = None
+        # Synthetic games are never written next to the real ones
+        self.recorder = None
+        self.tick_durations = []
+        self.tick_periods = []
+        self.overruns = 0
+        self.dropped_steps = 0
+
+    def new_game(self, group_name, seed=None):
+        game = super().new_game(group_name, seed)
+        game.input_log = None
+        return game
+
+    def tick(self, steps):
+        start = time.perf_counter()
+        self.channel_layer.tick_started = start
+        super().tick(steps)
+        self.tick_durations.append(time.perf_counter() - start)
+        self.tick_periods.append(self.scheduler.tick_period)
+        if self.scheduler.overrun > self.scheduler.step:
+            self.overruns += 1
+        self.dropped_steps += self.scheduler.dropped_steps
+
+
+class AsyncBenchEngine(BenchEngine, AsyncGameEngine):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the game engine with synthetic games'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=100, help='Number of concurrent games')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds to run the games for')
+        parser.add_argument('--input-interval', type=float, default=0.05, help='Seconds between two inputs of a player')
+        parser.add_argument('--batch', action='store_true', help='Use the batch physics mode')
+        parser.add_argument('--async', dest='async_engine', action='store_true',
+                            help='Run the engine in an event loop, as GAME_ENGINE_ASYNC does')
+        parser.add_argument('--output', default='engine_bench.json', help='File to write the results to')
+
+    def handle(self, *args, **options):
+        games = options['games']
+        duration = options['duration']
+        settings.GAME_ENGINE_BATCH_PHYSICS = options['batch']
+
+        layer = BenchChannelLayer(capacity=1000)
+        channel_layers.set(DEFAULT_CHANNEL_LAYER, layer)
+
+        engine = AsyncBenchEngine("bench") if options['async_engine'] else BenchEngine("bench")
+
+        # Two players connected to every game
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        group_names = []
+        for i in range(games):
+            left, right = 2 * i + 1, 2 * i + 2
+            group_name = "game_%d_%d" % (left, right)
+            for player in (left, right):
+                channel = async_to_sync(layer.new_channel)()
+                async_to_sync(layer.group_add)(group_name, channel)
+                engine.add_player(group_name, player, i + 1, None)
+            group_names.append(group_name)
+        memory_per_game = (tracemalloc.get_traced_memory()[0] - memory_before) / max(games, 1)
+        tracemalloc.stop()
+
+        self.stdout.write('Running %d games for %.1fs' % (games, duration))
+        inputs = [0]
+
+        def play():
+            # Scripted players follow the ball with their paddle, kick it again
+            # after every point and start a new game when one is over
+            for index, group_name in enumerate(group_names):
+                left, right = 2 * index + 1, 2 * index + 2
+                game = engine.games.get(group_name)
+                if game is None:
+                    continue
+                if game.status == game.GameStatus.FINISHED:
+                    # Run by the engine, as the messages of the consumers
+                    engine.submit(engine.end_game, group_name)
+                    engine.submit(engine.add_player, group_name, left, index + 1, None)
+                    engine.submit(engine.add_player, group_name, right, index + 1, None)
+                    continue
+                ball_y = game.dotY
+                for player, paddle in ((left, game.paddle_left), (right, game.paddle_right)):
+                    action = "UP" if ball_y < paddle else "DOWN"
+                    engine.inputs.put(group_name, player, action, "press")
+                    inputs[0] += 1
+                if not game.dotKicked:
+                    engine.inputs.put(group_name, left, "ENTER", "press")
+                    inputs[0] += 1
+
+        if options['async_engine']:
+            elapsed = asyncio.run(self.run_async(engine, layer, play, duration, options['input_interval']))
+        else:
+            elapsed = self.run_threads(engine, layer, play, duration, options['input_interval'])
+
+        results = {
+            'games': games,
+            'duration': elapsed,
+            'batch_physics': options['batch'],
+            'async_engine': options['async_engine'],
+            'tick_rate': settings.GAME_TICK_RATE,
+            'ticks': len(engine.tick_durations),
+            'tick_duration_ms': percentiles(engine.tick_durations),
+            'tick_period_ms': percentiles(engine.tick_periods),
+            'overruns': engine.overruns,
+            'dropped_steps': engine.dropped_steps,
+            'broadcast_lag_ms': percentiles(layer.broadcast_lags),
+            'group_send_latency_ms': percentiles(layer.send_latencies),
+            'group_sends_per_second': layer.group_sends / elapsed,
+            'messages_received_per_second': layer.received / elapsed,
+            'inputs_per_second': inputs[0] / elapsed,
+            'memory_per_game_bytes': memory_per_game,
+        }
+
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2)
+
+        self.stdout.write(json.dumps(results, indent=2))
+        self.stdout.write(self.style.SUCCESS('Results written to %s' % options['output']))
+
+    def run_threads(self, engine, layer, play, duration, input_interval):
+        engine.start()
+        stop = threading.Event()
+
+        def play_loop():
+            while not stop.is_set():
+                play()
+                stop.wait(input_interval)
+
+        def drain():
+            while not stop.is_set():
+                layer.drain()
+                stop.wait(0.005)
+
+        threads = [threading.Thread(target=play_loop, daemon=True), threading.Thread(target=drain, daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        started = time.perf_counter()
+        time.sleep(duration)
+        stop.set()
+        elapsed = time.perf_counter() - started
+        for thread in threads:
+            thread.join()
+        engine.stop()
+        engine.join()
+        return elapsed
+
+    async def run_async(self, engine, layer, play, duration, input_interval):
+        # The players and the consumers run on the loop of the engine, as
+        # the consumers of the worker do
+        engine.start()
+
+        async def play_loop():
+            while True:
+                play()
+                await asyncio.sleep(input_interval)
+
+        async def drain():
+            while True:
+                layer.drain()
+                await asyncio.sleep(0.005)
+
+        tasks = [asyncio.ensure_future(play_loop()), asyncio.ensure_future(drain())]
+        started = time.perf_counter()
+        await asyncio.sleep(duration)
+        elapsed = time.perf_counter() - started
+        for task in tasks:
+            task.cancel()
+        engine.stop()
+        await engine.task
+        return elapsed
@@ -0,0 +1,288 @@
+import asyncio
+import json
+import os
+import ssl
+import time
+from collections import Counter
+
+import requests
+from channels.db import database_sync_to_async
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from rest_framework_simplejwt.tokens import AccessToken
+
+from game_matchmaking.models import Game
+from game_sockets.metrics import percentiles
+from game_sockets.protocol import BINARY_SUBPROTOCOL, STATE_FRAME, STATE_FRAME_TYPE
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+
+class GameOver(Exception):
+    pass
+
+
+class LoadStats():
+    def __init__(self):
+        self.connect_latencies = []
+        self.frame_intervals = []
+        self.jitters = []
+        self.input_echoes = []
+        self.frames = 0
+        self.inputs = 0
+        self.games_started = 0
+        self.games_finished = 0
+        self.errors = Counter()
+
+
+class Bot():
+    """
+    Player that follows the ball with its paddle and serves after every
+    point, measuring what it receives.
+    """
+
+    def __init__(self, command, user, token, stats):
+        self.command = command
+        self.user = user
+        self.token = token
+        self.stats = stats
+        self.game = None
+        self.side = None
+        self.state = {}
+        self.direction = 0
+        # (sent at, direction, paddle when sent) of the last press
+        self.pending_echo = None
+        self.last_frame = None
+        self.last_interval = None
+        self.last_ball_move = time.perf_counter()
+        self.last_serve = 0
+        # Ping of the server to answer
+        self.ping = None
+
+    async def send(self, ws, message, state=None):
+        await ws.send(json.dumps({"message": message, "state": state, "tick": self.state.get("tick")}))
+        self.stats.inputs += 1
+
+    def parse(self, message):
+        if isinstance(message, bytes):
+            frame_type, tick, frame_time, ball_x, ball_y, paddle_left, paddle_right = STATE_FRAME.unpack(message)
+            if frame_type != STATE_FRAME_TYPE:
+                return None
+            return {"tick": tick, "ball": [ball_x, ball_y], "paddle_left": paddle_left, "paddle_right": paddle_right}
+        data = json.loads(message)
+        if "ping" in data:
+            self.ping = data["ping"]
+            return None
+        if "game_dict" in data:
+            return dict(data["game_dict"])
+        if "game_delta" in data:
+            return dict(self.state, **data["game_delta"])
+        if "end_dict" in data:
+            if "error" in data["end_dict"]:
+                self.stats.errors["game_error"] += 1
+            else:
+                self.stats.games_finished += 1
+            raise GameOver
+        return None
+
+    def observe_frame(self, now):
+        self.stats.frames += 1
+        if self.last_frame is not None:
+            interval = now - self.last_frame
+            self.stats.frame_intervals.append(interval)
+            if self.last_interval is not None:
+                self.stats.jitters.append(abs(interval - self.last_interval))
+            self.last_interval = interval
+        self.last_frame = now
+
+    async def play(self, ws, deadline):
+        paddle_key = "paddle_" + self.side
+        while True:
+            # Idle games send a frame every few seconds only, the bot must
+            # still serve in between
+            try:
+                message = await asyncio.wait_for(ws.recv(), 0.5)
+            except asyncio.TimeoutError:
+                message = None
+            now = time.perf_counter()
+            if now > deadline:
+                return
+
+            state = self.parse(message) if message is not None else None
+            if self.ping is not None:
+                await ws.send(json.dumps({"message": "PONG", "id": self.ping}))
+                self.ping = None
+            if state is not None:
+                if state.get("ball") != self.state.get("ball"):
+                    self.last_ball_move = now
+                self.state = state
+                self.observe_frame(now)
+
+            paddle = self.state.get(paddle_key)
+            if state is not None and self.pending_echo is not None and paddle is not None:
+                sent, direction, sent_paddle = self.pending_echo
+                if (paddle - sent_paddle) * direction > 0:
+                    self.stats.input_echoes.append(now - sent)
+                    self.pending_echo = None
+
+            # The left player serves when the ball stopped moving
+            if self.side == "left" and now - self.last_ball_move > 0.5 and now - self.last_serve > 0.5:
+                self.last_serve = now
+                await self.send(ws, "ENTER")
+
+            ball = self.state.get("ball")
+            if ball is None or paddle is None:
+                continue
+            direction = 0
+            if ball[1] < paddle - self.command.dead_zone:
+                direction = -1
+            elif ball[1] > paddle + self.command.dead_zone:
+                direction = 1
+            if direction != self.direction:
+                if self.direction:
+                    await self.send(ws, "UP" if self.direction < 0 else "DOWN", "release")
+                if direction:
+                    await self.send(ws, "UP" if direction < 0 else "DOWN", "press")
+                    self.pending_echo = (now, direction, paddle)
+                self.direction = direction
+
+    async def run(self, duration):
+        command = self.command
+        try:
+            await command.join_queue(self.token)
+        except requests.RequestException as e:
+            self.stats.errors["queue_join"] += 1
+            print("Error joining the queue: ", e)
+            return
+
+        self.game = await command.wait_for_game(self.user.id)
+        if self.game is None:
+            self.stats.errors["no_game"] += 1
+            return
+        self.side = "left" if self.game.playerLeft_id == self.user.id else "right"
+
+        url = "%s?token=%s&game=%d" % (command.ws_url, self.token, self.game.id)
+        options = {"open_timeout": command.timeout}
+        if url.startswith("wss://"):
+            options["ssl"] = command.ssl_context
+        if command.binary:
+            options["subprotocols"] = [BINARY_SUBPROTOCOL]
+
+        started = time.perf_counter()
+        try:
+            async with websockets.connect(url, **options) as ws:
+                self.stats.connect_latencies.append(time.perf_counter() - started)
+                if self.side == "left":
+                    self.stats.games_started += 1
+                try:
+                    await self.play(ws, time.perf_counter() + duration)
+                except GameOver:
+                    pass
+        except websockets.exceptions.ConnectionClosedError:
+            self.stats.errors["connection_closed"] += 1
+        except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+            self.stats.errors["connect"] += 1
+            print("Error connecting to the game: ", e)
+
+
+class Command(BaseCommand):
+    help = 'Load test the whole game path with websocket bot players (needs the websockets package)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=100, help='Number of concurrent games')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds every bot plays for')
+        parser.add_argument('--matchmaking-url', default=os.getenv('MATCHMAKING_SERVICE_HOST', 'https://localhost/matchmaking'),
+                            help='Base URL of the matchmaking service')
+        parser.add_argument('--ws-url', default=os.getenv('GAME_SOCKETS_HOST', 'wss://localhost/ws/game') + '/game/',
+                            help='URL of the game websocket')
+        parser.add_argument('--user-prefix', default='loadtest_', help='Prefix of the usernames of the bots')
+        parser.add_argument('--ramp-up', type=float, default=10, help='Seconds over which the bots join the queue')
+        parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for a game or a connection')
+        parser.add_argument('--binary', action='store_true', help='Receive the binary state frames')
+        parser.add_argument('--output', default='loadtest.json', help='File to write the results to')
+
+    def handle(self, *args, **options):
+        if websockets is None:
+            raise CommandError('The loadtest command needs the websockets package: pip install websockets')
+
+        self.matchmaking_url = options['matchmaking_url'].rstrip('/')
+        self.ws_url = options['ws_url']
+        self.timeout = options['timeout']
+        self.binary = options['binary']
+        self.dead_zone = 3
+        # The local stack uses a self signed certificate
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.http = requests.Session()
+
+        users = self.create_users(options['user_prefix'], options['games'] * 2)
+        tokens = {user.id: str(AccessToken.for_user(user)) for user in users}
+
+        stats = LoadStats()
+        started = time.perf_counter()
+        asyncio.run(self.run_bots(users, tokens, stats, options['duration'], options['ramp_up']))
+        elapsed = time.perf_counter() - started
+
+        results = {
+            'games': options['games'],
+            'duration': elapsed,
+            'games_started': stats.games_started,
+            'games_finished': stats.games_finished,
+            'connect_latency_ms': percentiles(stats.connect_latencies),
+            'frame_interval_ms': percentiles(stats.frame_intervals),
+            'frame_jitter_ms': percentiles(stats.jitters),
+            'input_echo_ms': percentiles(stats.input_echoes),
+            'frames_per_second': stats.frames / elapsed,
+            'inputs_per_second': stats.inputs / elapsed,
+            'errors': dict(stats.errors),
+        }
+
+        with open(options['output'], 'w') as f:
+            json.dump(results, f, indent=2)
+
+        self.stdout.write(json.dumps(results, indent=2))
+        self.stdout.write(self.style.SUCCESS('Results written to %s' % options['output']))
+
+    def create_users(self, prefix, count):
+        users = []
+        for i in range(count):
+            user, _ = User.objects.get_or_create(username="%s%d" % (prefix, i))
+            users.append(user)
+        # Games left over by a previous run would be found instead of the new ones
+        Game.objects.filter(Q(playerLeft__in=users) | Q(playerRight__in=users)).exclude(
+            status=Game.GameStatus.FINISHED).update(status=Game.GameStatus.FINISHED)
+        return users
+
+    async def run_bots(self, users, tokens, stats, duration, ramp_up):
+        bots = [Bot(self, user, tokens[user.id], stats) for user in users]
+        delay = ramp_up / max(len(bots), 1)
+
+        async def start(index, bot):
+            await asyncio.sleep(index * delay)
+            await bot.run(duration)
+
+        await asyncio.gather(*(start(index, bot) for index, bot in enumerate(bots)))
+
+    async def join_queue(self, token):
+        def post():
+            response = self.http.post(self.matchmaking_url + '/queue/join/', verify=False, timeout=self.timeout,
+                                      headers={'Authorization': 'Bearer ' + token})
+            response.raise_for_status()
+        await asyncio.get_running_loop().run_in_executor(None, post)
+
+    async def wait_for_game(self, user_id):
+        find = database_sync_to_async(lambda: Game.objects.filter(
+            Q(playerLeft_id=user_id) | Q(playerRight_id=user_id)).filter(
+            status__in=[Game.GameStatus.WAITING, Game.GameStatus.IN_PROGRESS]).order_by('-id').first())
+        deadline = time.perf_counter() + self.timeout
+        while time.perf_counter() < deadline:
+            game = await find()
+            if game is not None:
+                return game
+            await asyncio.sleep(0.2)
+        return None
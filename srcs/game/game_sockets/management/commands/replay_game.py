@@ -0,0 +1,103 @@
+import json
+import time
+
+from channels.layers import DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer, channel_layers
+from django.core.management.base import BaseCommand, CommandError
+
+from game_sockets.engine import GameEngine
+from game_sockets.persistence import NullPersistence
+from game_sockets.replay import CONNECT_ACTION, DISCONNECT_ACTION, read_input_log
+
+
+class ReplayEngine(GameEngine):
+    """
+    Engine that simulates a single game as fast as possible, without the
+    database, Redis or a tick loop.
+    """
+
+    def __init__(self, tick_rate, lag_window=0):
+        super().__init__("replay")
+        self.persistence = NullPersistence()
+        self.publisher = None
+        self.checkpoints = None
+        self.recorder = None
+        self.batch = None
+        self.step_scale = self.SPEED_TICK_RATE / tick_rate
+        self.lag_window = lag_window
+
+    def rewind_limit(self, user_id):
+        # The client ticks of the log were limited by the live engine
+        return self.lag_window
+
+    def step(self, game):
+        game.tick += 1
+        self.move_paddles(game)
+        self.update_ball_position(game.group_name)
+
+    def replay(self, header, inputs, until_tick=None):
+        game = self.new_game(header["group_name"], header["seed"])
+        game.input_log = None
+        game.game_id = header["game_id"]
+        # Logs without the connections were only written while playing
+        if header.get("version", 1) < 2:
+            game.status = game.GameStatus.PLAYING
+        self.games[game.group_name] = game
+
+        for tick, user_id, action, state, *client_tick in inputs:
+            # Ticks only advance while playing, as in the engine
+            while game.tick < tick and game.status == game.GameStatus.PLAYING:
+                self.step(game)
+            if action == CONNECT_ACTION:
+                game.add_player(user_id, game.game_id, None)
+                continue
+            if action == DISCONNECT_ACTION:
+                try:
+                    game.remove_player(user_id)
+                except game.PlayersDisconnectedError:
+                    # Both players left, the game was over
+                    break
+                continue
+            self.apply_input(game, user_id, action, state, client_tick[0] if client_tick else None)
+        if until_tick is not None:
+            while game.tick < until_tick and game.status == game.GameStatus.PLAYING:
+                self.step(game)
+        return game
+
+
+class Command(BaseCommand):
+    help = 'Simulate a game again from its input log and check its result'
+
+    def add_arguments(self, parser):
+        parser.add_argument('log', help='Input log of the game, from GAME_INPUT_LOG_DIR')
+
+    def handle(self, *args, **options):
+        try:
+            header, inputs, result = read_input_log(options['log'])
+        except (OSError, ValueError) as e:
+            raise CommandError('Cannot read %s: %s' % (options['log'], e))
+        if header is None:
+            raise CommandError('%s is empty' % options['log'])
+
+        # The end of the game is sent to nobody
+        channel_layers.set(DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer())
+
+        engine = ReplayEngine(header["tick_rate"], header.get("lag_window", 0))
+        started = time.perf_counter()
+        game = engine.replay(header, inputs, result["tick"] if result else None)
+        elapsed = time.perf_counter() - started
+
+        replayed = {"tick": game.tick, "result": [game.playerLeftScore, game.playerRightScore]}
+        self.stdout.write(json.dumps({
+            "game_id": header["game_id"],
+            "inputs": len(inputs),
+            "recorded": result,
+            "replayed": replayed,
+            "seconds": elapsed,
+        }, indent=2))
+
+        if result is None:
+            self.stdout.write(self.style.WARNING('The game was not over, nothing to compare'))
+        elif result != replayed:
+            raise CommandError('The replay does not match the recorded result')
+        else:
+            self.stdout.write(self.style.SUCCESS('The replay matches the recorded result'))
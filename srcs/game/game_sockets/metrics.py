@@ -0,0 +1,195 @@
+import bisect
+import json
+import math
+import threading
+import time
+
+import redis
+from django.conf import settings
+
+from .network import network_key
+
+METRICS_KEY_PREFIX = "game_engine:metrics:"
+
+
+class Histogram():
+    """
+    Cumulative histogram with fixed buckets, in seconds.
+    """
+
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.016, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # The last count is for the values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        return {
+            "buckets": list(self.buckets),
+            "counts": list(self.counts),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+class EngineMetrics():
+    """
+    Counters of a game engine worker. They are written by the engine thread
+    only, and read by the MetricsPublisher.
+    """
+
+    def __init__(self):
+        self.tick_duration = Histogram()
+        self.group_send_latency = Histogram()
+        # Round trips and jitter measured on the game sockets
+        self.client_rtt = Histogram()
+        self.client_jitter = Histogram()
+        self.ticks = 0
+        self.overruns = 0
+        self.dropped_steps = 0
+        self.inputs = 0
+
+    def observe_tick(self, duration, scheduler):
+        self.tick_duration.observe(duration)
+        self.ticks += 1
+        # Late by more than a whole step, the game slowed down for the players
+        if scheduler.dropped_steps or scheduler.overrun > scheduler.step:
+            self.overruns += 1
+        self.dropped_steps += scheduler.dropped_steps
+
+
+class MetricsPublisher(threading.Thread):
+    """
+    Pushes the metrics of the engine to Redis every `interval` seconds, for
+    the HTTP process to serve them on /metrics/, with the network quality of
+    every connection for /network/.
+    """
+
+    def __init__(self, engine, interval=5, **kwargs):
+        super().__init__(daemon=True, name="MetricsPublisher", **kwargs)
+        self.engine = engine
+        self.interval = interval
+        self.key = METRICS_KEY_PREFIX + engine.channel_name
+        self.redis = redis.Redis(host=settings.REDIS_HOST, port=6379)
+        self.last_inputs = 0
+        self.last_time = time.monotonic()
+
+    def run(self):
+        while not self.engine.stopped.wait(self.interval):
+            try:
+                self.publish()
+            except Exception as e:
+                print("Error publishing engine metrics: ", e)
+
+    def snapshot(self):
+        metrics = self.engine.metrics
+        now = time.monotonic()
+        inputs = metrics.inputs
+        inputs_per_second = (inputs - self.last_inputs) / (now - self.last_time)
+        self.last_inputs, self.last_time = inputs, now
+
+        games = {}
+        for game in list(self.engine.games.values()):
+            games[game.status] = games.get(game.status, 0) + 1
+
+        return {
+            "shard": self.engine.channel_name,
+            "time": time.time(),
+            "ticks": metrics.ticks,
+            "overruns": metrics.overruns,
+            "dropped_steps": metrics.dropped_steps,
+            "tick_period": self.engine.scheduler.tick_period,
+            "inputs": inputs,
+            "inputs_per_second": inputs_per_second,
+            "games": games,
+            "spectators": sum(list(self.engine.spectators.values())),
+            "measured_connections": len(self.engine.network),
+            "tick_duration": metrics.tick_duration.to_dict(),
+            "group_send_latency": metrics.group_send_latency.to_dict(),
+            "client_rtt": metrics.client_rtt.to_dict(),
+            "client_jitter": metrics.client_jitter.to_dict(),
+        }
+
+    def publish(self):
+        # Expires if the worker dies, so a dead shard disappears from /metrics/,
+        # and the connections closed since disappear from /network/
+        # Redis only takes whole seconds
+        expiry = max(1, math.ceil(self.interval * 3))
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(self.key, json.dumps(self.snapshot()), ex=expiry)
+        for user_id, network in list(self.engine.network.items()):
+            pipe.set(network_key(user_id), json.dumps(network), ex=expiry)
+        pipe.execute()
+
+
+def percentiles(values):
+    """
+    Summary of durations in seconds, in milliseconds.
+    """
+    if not values:
+        return {"p50": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def at(fraction):
+        return values[min(len(values) - 1, int(fraction * len(values)))] * 1000
+
+    return {"p50": at(0.50), "p99": at(0.99), "max": values[-1] * 1000}
+
+
+def load_engine_metrics(client):
+    snapshots = []
+    for key in client.scan_iter(METRICS_KEY_PREFIX + "*"):
+        value = client.get(key)
+        if value is not None:
+            snapshots.append(json.loads(value))
+    return snapshots
+
+
+def _render_histogram(lines, name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(histogram["buckets"], histogram["counts"]):
+        cumulative += count
+        lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative))
+    lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, histogram["count"]))
+    lines.append('%s_sum{%s} %f' % (name, labels, histogram["sum"]))
+    lines.append('%s_count{%s} %d' % (name, labels, histogram["count"]))
+
+
+def render_prometheus(snapshots):
+    """
+    Render the snapshots of every engine worker in the Prometheus text format.
+    """
+    lines = []
+    for name, key in (("pong_engine_tick_seconds", "tick_duration"),
+                      ("pong_engine_group_send_seconds", "group_send_latency"),
+                      ("pong_engine_client_rtt_seconds", "client_rtt"),
+                      ("pong_engine_client_jitter_seconds", "client_jitter")):
+        lines.append("# TYPE %s histogram" % name)
+        for snapshot in snapshots:
+            _render_histogram(lines, name, 'shard="%s"' % snapshot["shard"], snapshot[key])
+
+    for name, kind, key in (("pong_engine_ticks_total", "counter", "ticks"),
+                            ("pong_engine_overruns_total", "counter", "overruns"),
+                            ("pong_engine_dropped_steps_total", "counter", "dropped_steps"),
+                            ("pong_engine_inputs_total", "counter", "inputs"),
+                            ("pong_engine_inputs_per_second", "gauge", "inputs_per_second"),
+                            ("pong_engine_tick_period_seconds", "gauge", "tick_period"),
+                            ("pong_engine_spectators", "gauge", "spectators"),
+                            ("pong_engine_measured_connections", "gauge", "measured_connections")):
+        lines.append("# TYPE %s %s" % (name, kind))
+        for snapshot in snapshots:
+            lines.append('%s{shard="%s"} %s' % (name, snapshot["shard"], snapshot[key]))
+
+    lines.append("# TYPE pong_engine_games gauge")
+    for snapshot in snapshots:
+        for status, count in snapshot["games"].items():
+            lines.append('pong_engine_games{shard="%s",status="%s"} %d' % (snapshot["shard"], status, count))
+    return "\n".join(lines) + "\n"
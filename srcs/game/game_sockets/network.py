@@ -0,0 +1,51 @@
+import json
+
+NETWORK_KEY_PREFIX = "game_engine:network:"
+
+
+def network_key(user_id):
+    return NETWORK_KEY_PREFIX + str(user_id)
+
+
+class NetworkQuality():
+    """
+    Round trip time and jitter of a game socket, measured with the ping/pong
+    exchange of the consumer, in seconds.
+
+    The smoothed RTT is the one of TCP (RFC 6298) and the jitter the one of
+    RTP (RFC 3550): the mean deviation between consecutive round trips.
+    """
+
+    def __init__(self):
+        self.rtt = None
+        self.srtt = None
+        self.min_rtt = None
+        self.jitter = 0.0
+        self.samples = 0
+
+    def observe(self, rtt):
+        if self.rtt is not None:
+            self.jitter += (abs(rtt - self.rtt) - self.jitter) / 16
+        self.srtt = rtt if self.srtt is None else self.srtt + (rtt - self.srtt) / 8
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.rtt = rtt
+        self.samples += 1
+
+    def to_dict(self):
+        return {
+            "rtt": self.rtt,
+            "srtt": self.srtt,
+            "min_rtt": self.min_rtt,
+            "jitter": self.jitter,
+            "samples": self.samples,
+        }
+
+
+def load_network_quality(client, user_ids):
+    """
+    Network quality of the connections of the users, None for the users that
+    are not connected to a game.
+    """
+    values = client.mget([network_key(user_id) for user_id in user_ids]) if user_ids else []
+    return {user_id: json.loads(value) if value is not None else None
+            for user_id, value in zip(user_ids, values)}
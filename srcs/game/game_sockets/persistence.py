@@ -0,0 +1,110 @@
+import threading
+
+from django.db import close_old_connections
+
+
+class GamePersistence(threading.Thread):
+    """
+    Write-behind queue for the rows the engine updates.
+
+    The engine only records the new values of the fields, the updates of the
+    same row are coalesced and written in the background with one
+    bulk_update per model and set of fields, every `interval` seconds or
+    when flush() is called. The tick loop never waits for the database.
+
+    Jobs submitted with submit() run on the same thread, in order, after the
+    updates queued before them have been written.
+    """
+
+    def __init__(self, interval=1.0, **kwargs):
+        super().__init__(daemon=True, name="GamePersistence", **kwargs)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # (model, pk) -> {field: value}
+        self.pending = {}
+        self.jobs = []
+
+    def update(self, model, pk, **fields):
+        if pk is None:
+            return
+        with self.lock:
+            self.pending.setdefault((model, pk), {}).update(fields)
+
+    def submit(self, job, *args):
+        with self.lock:
+            self.jobs.append((job, args))
+        self.wakeup.set()
+
+    def flush(self):
+        """
+        Ask the worker to write the pending updates now, without waiting.
+        """
+        self.wakeup.set()
+
+    def stop(self):
+        """
+        Write everything that is still pending, from the calling thread.
+        """
+        self.process()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.process()
+
+    def process(self):
+        # Both are taken at once so a job never runs before the updates
+        # that were queued ahead of it
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            jobs, self.jobs = self.jobs, []
+        self.write(pending)
+        self.run_jobs(jobs)
+
+    def run_jobs(self, jobs):
+        for job, args in jobs:
+            try:
+                job(*args)
+            except Exception as e:
+                print("Error running %s: " % job.__name__, e)
+
+    def write(self, pending):
+        if not pending:
+            return
+
+        batches = {}
+        for (model, pk), fields in pending.items():
+            # Fields may be given by attname (winner_id), bulk_update wants names
+            names = tuple(sorted(model._meta.get_field(name).name for name in fields))
+            batches.setdefault((model, names), []).append(model(pk=pk, **fields))
+
+        close_old_connections()
+        for (model, names), objs in batches.items():
+            try:
+                model.objects.bulk_update(objs, names)
+            except Exception as e:
+                print("Error saving %s: " % model.__name__, e)
+
+
+class NullPersistence():
+    """
+    Stands in for GamePersistence when a game must not touch the database,
+    in the benchmark and the replays.
+    """
+
+    def update(self, model, pk, **fields):
+        pass
+
+    def submit(self, job, *args):
+        pass
+
+    def flush(self):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
@@ -0,0 +1,57 @@
+import json
+import struct
+import time
+
+# Websocket subprotocol a client can ask for on /ws/game/ to receive the
+# game state as binary frames. Scores and the end of the game stay JSON.
+BINARY_SUBPROTOCOL = "pong.binary.v2"
+
+STATE_FRAME_TYPE = 1
+
+# Little endian: frame type, tick, server time in milliseconds, ball x,
+# ball y, left paddle, right paddle
+STATE_FRAME = struct.Struct("<BIdffff")
+
+
+def server_time():
+    """
+    Wall clock in milliseconds, the time base of the frames and of the clock
+    sync of the clients.
+    """
+    return round(time.time() * 1000, 1)
+
+
+def pack_state_frame(snapshot, frame_time):
+    ball = snapshot.ball
+    return STATE_FRAME.pack(STATE_FRAME_TYPE, snapshot.tick, frame_time, ball[0], ball[1],
+                            snapshot.paddle_left, snapshot.paddle_right)
+
+
+def sync_reply(client_time):
+    """
+    Answer to a clock sync request: the client estimates the offset of its
+    clock from the time it sent, the server time and the round trip.
+    """
+    return json.dumps({"sync": {"client_time": client_time, "server_time": server_time()}})
+
+
+# Events of the game groups. The engine serializes every frame once, the
+# consumers forward the text, or the bytes to binary clients, as they are.
+
+def state_event(key, payload, snapshot, frame_time):
+    """
+    `payload` is sent as JSON under `key` ("game_dict" or "game_delta"),
+    binary clients get the full `snapshot`. Both carry the tick and the
+    server time of the frame.
+    """
+    payload["tick"] = snapshot.tick
+    payload["time"] = frame_time
+    return {"type": "game_frame", "text": json.dumps({key: payload}), "bytes": pack_state_frame(snapshot, frame_time)}
+
+
+def score_event(left, right):
+    return {"type": "score_update", "text": json.dumps({"score_dict": {"left": left, "right": right}})}
+
+
+def end_event(end_dict):
+    return {"type": "game_end", "text": json.dumps({"end_dict": end_dict})}
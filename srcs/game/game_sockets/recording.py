@@ -0,0 +1,157 @@
+import mmap
+import os
+import queue
+import struct
+import threading
+
+RECORDING_MAGIC = b"PONGREC1"
+
+# Little endian: tick, ball x, ball y, left paddle, right paddle, events
+RECORD = struct.Struct("<IffffB")
+
+# Bits of the events of a record
+EVENT_GOAL_LEFT = 1
+EVENT_GOAL_RIGHT = 2
+EVENT_FINISHED = 4
+
+# Records of a buffer, a game hands its buffer to the writer when it is full
+RECORDS_PER_BUFFER = 256
+
+
+def recording_path(directory, game_id):
+    return os.path.join(directory, "%d.rec" % game_id)
+
+
+class RecordingWriter(threading.Thread):
+    """
+    Appends the buffers filled by the engine to the recording files.
+
+    Buffers are preallocated and reused: the engine takes an empty one from
+    the pool, fills it in place with RECORD.pack_into and hands it back
+    once full, so recording allocates nothing in the tick loop.
+    """
+
+    def __init__(self, directory, **kwargs):
+        super().__init__(daemon=True, name="RecordingWriter", **kwargs)
+        self.directory = directory
+        self.buffer_size = RECORD.size * RECORDS_PER_BUFFER
+        self.pool = queue.SimpleQueue()
+        self.jobs = queue.SimpleQueue()
+
+    def acquire(self):
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            # Only while the pool grows to the number of games recorded
+            return bytearray(self.buffer_size)
+
+    def open(self, game_id):
+        return Recording(self, recording_path(self.directory, game_id))
+
+    def submit(self, path, buffer, count):
+        self.jobs.put((path, buffer, count))
+
+    def run(self):
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            path, buffer, count = self.jobs.get()
+            try:
+                self.write(path, buffer, count)
+            except OSError as e:
+                print("Error writing recording %s: " % path, e)
+            self.pool.put(buffer)
+
+    def write(self, path, buffer, count):
+        with open(path, "ab") as f:
+            if f.tell() == 0:
+                f.write(RECORDING_MAGIC)
+            f.write(memoryview(buffer)[:count * RECORD.size])
+
+
+class Recording():
+    """
+    Frames of one game waiting in a buffer to be written.
+    """
+
+    def __init__(self, writer, path):
+        self.writer = writer
+        self.path = path
+        self.buffer = writer.acquire()
+        self.count = 0
+
+    def record(self, tick, ball_x, ball_y, paddle_left, paddle_right, events=0):
+        RECORD.pack_into(self.buffer, self.count * RECORD.size,
+                         tick, ball_x, ball_y, paddle_left, paddle_right, events)
+        self.count += 1
+        if self.count == RECORDS_PER_BUFFER:
+            self.flush()
+
+    def flush(self):
+        if self.count == 0:
+            return
+        self.writer.submit(self.path, self.buffer, self.count)
+        self.buffer = self.writer.acquire()
+        self.count = 0
+
+    def close(self):
+        self.flush()
+        self.writer.pool.put(self.buffer)
+        self.buffer = None
+
+
+class RecordingReader():
+    """
+    Memory mapped recording, the records are read in place and found by
+    tick with a binary search.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < len(RECORDING_MAGIC):
+                raise ValueError("%s is not a recording" % path)
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(RECORDING_MAGIC)] != RECORDING_MAGIC:
+            self.close()
+            raise ValueError("%s is not a recording" % path)
+        # A record being written when the file was opened is left out
+        self.count = (size - len(RECORDING_MAGIC)) // RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return RECORD.unpack_from(self.mmap, len(RECORDING_MAGIC) + index * RECORD.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.mmap.close()
+
+    def tick_index(self, tick):
+        """
+        Index of the first record at or after `tick`.
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self[middle][0] < tick:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def frames(self, start_tick=0, end_tick=None):
+        index = self.tick_index(start_tick)
+        while index < self.count:
+            record = self[index]
+            if end_tick is not None and record[0] > end_tick:
+                return
+            yield record
+            index += 1
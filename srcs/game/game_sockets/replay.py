@@ -0,0 +1,91 @@
+import json
+import os
+
+# Version 2 logs the connections of the players, the replay of a version 1
+# log plays it from the first tick
+INPUT_LOG_VERSION = 2
+
+# Actions of the entries of the players joining and leaving the game, which
+# pause and resume it
+CONNECT_ACTION = "CONNECT"
+DISCONNECT_ACTION = "DISCONNECT"
+
+
+class InputLog():
+    """
+    Append-only log of the inputs applied to a game, stamped with the tick
+    of the game they were applied on.
+
+    The game is seeded, so its seed and this log are enough to simulate it
+    again. The log is written as JSON lines: a header, one line per input
+    or connection and the result once the game is over.
+    """
+
+    def __init__(self, path, tick_rate, lag_window=0):
+        self.path = path
+        self.tick_rate = tick_rate
+        self.lag_window = lag_window
+        self.entries = []
+        # A game restored from a checkpoint goes on with the same file
+        self.started = os.path.exists(path)
+        self.closed = False
+
+    def append(self, tick, user_id, action, state, client_tick=None):
+        if self.closed:
+            return
+        if client_tick is None:
+            self.entries.append([tick, user_id, action, state])
+        else:
+            # The tick the player was seeing sets the rewind of their paddle
+            self.entries.append([tick, user_id, action, state, client_tick])
+
+    def connection(self, tick, user_id, connected):
+        self.append(tick, user_id, CONNECT_ACTION if connected else DISCONNECT_ACTION, None)
+
+    def take(self, game, finished=False):
+        """
+        Return the lines to append to the file since the last call.
+        """
+        if self.closed:
+            return []
+        lines = []
+        if not self.started:
+            self.started = True
+            lines.append({"group_name": game.group_name, "game_id": game.game_id,
+                          "seed": game.seed, "tick_rate": self.tick_rate, "lag_window": self.lag_window,
+                          "version": INPUT_LOG_VERSION})
+        lines.extend(self.entries)
+        self.entries = []
+        if finished:
+            self.closed = True
+            lines.append({"tick": game.tick, "result": [game.playerLeftScore, game.playerRightScore]})
+        return [json.dumps(line, separators=(",", ":")) for line in lines]
+
+
+def input_log_path(directory, group_name, seed):
+    return os.path.join(directory, "%s_%d.jsonl" % (group_name, seed))
+
+
+def append_input_log(path, lines):
+    with open(path, "a") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def read_input_log(path):
+    """
+    Return the header, the inputs and the result of a log, or None as result
+    when the game was not over.
+    """
+    header, inputs, result = None, [], None
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if isinstance(entry, list):
+                inputs.append(entry)
+            elif header is None:
+                header = entry
+            else:
+                result = entry
+    return header, inputs, result
@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+
+class TickScheduler():
+    """
+    Fixed timestep scheduler for the game engine loop.
+
+    Wall time is accumulated between calls to wait() and consumed in fixed
+    simulation steps, so the simulation advances at the same speed no matter
+    how long a tick takes. When the engine falls too far behind only
+    max_catchup_steps are run and the rest of the backlog is dropped.
+    """
+
+    def __init__(self, tick_rate=60, max_catchup_steps=5):
+        self.step = 1.0 / tick_rate
+        self.max_catchup_steps = max_catchup_steps
+
+        self.accumulator = 0.0
+        self.last_time = None
+        self.next_deadline = None
+
+        # Measured values of the last tick
+        self.tick_period = self.step
+        self.overrun = 0.0
+        self.dropped_steps = 0
+
+    def wait(self):
+        """
+        Sleep until the next tick is due and return the number of
+        simulation steps that have to be run on this tick.
+        """
+        delay = self.delay()
+        if delay > 0:
+            time.sleep(delay)
+        return self.advance()
+
+    async def wait_async(self):
+        """
+        Same as wait(), without blocking the event loop.
+        """
+        delay = self.delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return self.advance()
+
+    def delay(self):
+        if self.last_time is None:
+            return 0.0
+        return self.next_deadline - time.perf_counter()
+
+    def advance(self):
+        now = time.perf_counter()
+        if self.last_time is None:
+            self.last_time = now
+            self.next_deadline = now
+            return 1
+
+        self.tick_period = now - self.last_time
+        self.overrun = max(0.0, now - self.next_deadline)
+        self.accumulator += self.tick_period
+        self.last_time = now
+
+        # The epsilon avoids losing a step to floating point rounding
+        steps = int(self.accumulator / self.step + 1e-6)
+        self.dropped_steps = 0
+        if steps > self.max_catchup_steps:
+            self.dropped_steps = steps - self.max_catchup_steps
+            steps = self.max_catchup_steps
+            self.accumulator = 0.0
+        else:
+            self.accumulator -= steps * self.step
+
+        # Keep the deadlines on the fixed grid, unless we are so late that
+        # catching up would only produce a burst of ticks
+        self.next_deadline += self.step
+        if self.next_deadline < now:
+            self.next_deadline = now + self.step - self.accumulator
+
+        return steps
@@ -0,0 +1,73 @@
+import bisect
+import hashlib
+
+from django.conf import settings
+
+ENGINE_CHANNEL_PREFIX = "game_engine"
+# Paddle input has its own channel so it never delays the control messages
+ENGINE_INPUT_CHANNEL_PREFIX = "game_engine_input"
+
+
+def engine_channel_name(shard):
+    return "%s.%d" % (ENGINE_CHANNEL_PREFIX, shard)
+
+
+def engine_input_channel_name(shard):
+    return "%s.%d" % (ENGINE_INPUT_CHANNEL_PREFIX, shard)
+
+
+class ConsistentHashRing():
+    """
+    Maps keys to nodes so that adding or removing a node only moves the keys
+    that belonged to it. Every node is placed on the ring several times
+    (virtual nodes) to spread the keys evenly.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.replicas = replicas
+        self.ring = []
+        self.nodes = {}
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def add_node(self, node):
+        for i in range(self.replicas):
+            point = self.hash("%s#%d" % (node, i))
+            self.nodes[point] = node
+            bisect.insort(self.ring, point)
+
+    def remove_node(self, node):
+        for i in range(self.replicas):
+            point = self.hash("%s#%d" % (node, i))
+            self.nodes.pop(point, None)
+            self.ring.remove(point)
+
+    def get_node(self, key):
+        if not self.ring:
+            return None
+        index = bisect.bisect(self.ring, self.hash(key)) % len(self.ring)
+        return self.nodes[self.ring[index]]
+
+
+ring = ConsistentHashRing(
+    [engine_channel_name(shard) for shard in range(settings.GAME_ENGINE_WORKERS)]
+)
+
+
+def engine_channel_for(group_name):
+    """
+    Return the channel of the engine worker that owns the given game group.
+    """
+    return ring.get_node(group_name)
+
+
+def engine_input_channel_for(group_name):
+    """
+    Return the input channel of the engine worker that owns the given group.
+    """
+    shard = ring.get_node(group_name)[len(ENGINE_CHANNEL_PREFIX) + 1:]
+    return "%s.%s" % (ENGINE_INPUT_CHANNEL_PREFIX, shard)
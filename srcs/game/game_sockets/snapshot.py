@@ -0,0 +1,19 @@
+from collections import namedtuple
+
+# State of a game at a tick, as sent to the clients. The engine simulates on
+# the fields of the game and replaces the snapshot once they are consistent,
+# a snapshot is never modified, so it can be read and kept without a copy.
+GameSnapshot = namedtuple("GameSnapshot", ("paddle_right", "paddle_left", "ball", "tick"))
+
+# Fields compared to find what changed between two snapshots
+STATE_FIELDS = GameSnapshot._fields[:-1]
+
+
+def snapshot_delta(snapshot, sent):
+    """
+    Fields of `snapshot` that changed since the snapshot `sent`, all of them
+    when nothing was sent yet.
+    """
+    if sent is None:
+        return dict(zip(STATE_FIELDS, snapshot))
+    return {field: value for field, value, old in zip(STATE_FIELDS, snapshot, sent) if value != old}
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import threading
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+
+def spectator_group_name(group_name):
+    return group_name + "_spectators"
+
+
+class Fanout():
+    """
+    Frames of the spectators waiting to be sent, shared by the fanout of the
+    threaded engine and the one of the asyncio engine, which only differ in
+    how they are woken up and where they send.
+
+    The engine hands over one serialized payload per game. Only the latest
+    payload of a game is kept until it is sent, the end of a game is never
+    replaced by a frame, and the payloads of all the games are sent together.
+    """
+
+    def __init__(self):
+        self.channel_layer = get_channel_layer()
+        self.lock = threading.Lock()
+        # spectator group -> (text, close)
+        self.pending = {}
+
+    def publish_state(self, group_name, snapshot, left, right, frame_time):
+        self.publish(group_name, json.dumps({
+            "game_dict": dict(snapshot._asdict(), time=frame_time),
+            "score_dict": {"left": left, "right": right},
+        }))
+
+    def publish_end(self, group_name, winner, left, right):
+        # The spectators are disconnected once they got it
+        self.publish(group_name, json.dumps({"end_dict": {
+            "end": "Game finished", "winner": winner, "score": {"left": left, "right": right},
+        }}), close=True)
+
+    def publish(self, group_name, text, close=False):
+        group_name = spectator_group_name(group_name)
+        with self.lock:
+            if not self.pending.get(group_name, (None, False))[1]:
+                self.pending[group_name] = (text, close)
+        self.wake()
+
+    def wake(self):
+        raise NotImplementedError
+
+    async def send_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        results = await asyncio.gather(*(
+            self.channel_layer.group_send(group_name, {"type": "spectator_update", "text": text, "close": close})
+            for group_name, (text, close) in pending.items()
+        ), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print("Error sending spectator frame: ", result)
+
+
+class SpectatorFanout(Fanout, threading.Thread):
+    """
+    Sends the frames of the spectators from its own thread, so a game with
+    many spectators never delays the tick or the frames of the players.
+    """
+
+    def __init__(self, **kwargs):
+        Fanout.__init__(self)
+        threading.Thread.__init__(self, daemon=True, name="SpectatorFanout", **kwargs)
+        self.wakeup = threading.Event()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            try:
+                async_to_sync(self.send_pending)()
+            except Exception as e:
+                print("Error sending spectator frames: ", e)
+
+
+class LoopFanout(Fanout):
+    """
+    Fanout of the engine running in the event loop. A task of the same loop
+    sends the frames, the engine never waits for it, and only the latest
+    payload of a game is kept while the previous frames are still being sent.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.wakeup = None
+        self.task = None
+
+    def start(self):
+        # Created here to be bound to the loop of the engine
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def wake(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            await self.send_pending()
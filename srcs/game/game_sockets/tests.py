@@ -1,3 +1,920 @@
-from django.test import TestCase
+import asyncio
+import json
+import random
+import shutil
+import tempfile
+import time
+from collections import deque
+from datetime import timedelta
+from unittest import mock, skipIf
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from game_matchmaking.models import Game
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from .consumers import ClientConsumer
+from .engine import AsyncGameEngine, GameEngine, GameInstance
+from .inputs import InputMailbox
+from .management.commands.replay_game import ReplayEngine
+from .network import NetworkQuality
+from .persistence import GamePersistence, NullPersistence
+from .protocol import STATE_FRAME, STATE_FRAME_TYPE, pack_state_frame, state_event, sync_reply
+from .physics import BALL_MAX, RIGHT_PADDLE_FACE, sweep_ball
+from .recording import (EVENT_GOAL_LEFT, RECORD, RECORDING_MAGIC, RECORDS_PER_BUFFER, RecordingReader,
+                        RecordingWriter, recording_path)
+from .replay import CONNECT_ACTION, DISCONNECT_ACTION, read_input_log
+from .scheduler import TickScheduler
+from .snapshot import GameSnapshot
+from .spectators import LoopFanout, SpectatorFanout
+from .sharding import ConsistentHashRing
+from .timers import DeadlineHeap
+from .views import game_replay
+
+try:
+    import numpy as np
+    from .batch import BatchPhysics
+except ImportError:
+    np = None
+
+IN_MEMORY_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+# Engines of the tests keep everything in memory
+ENGINE_SETTINGS = {
+    "CHANNEL_LAYERS": IN_MEMORY_LAYERS, "GAME_CHECKPOINT_INTERVAL": 0, "GAME_METRICS_INTERVAL": 0,
+    "GAME_RECORDING_DIR": "", "GAME_INPUT_LOG_DIR": "", "GAME_ENGINE_BATCH_PHYSICS": False,
+}
+
+
+class TickSchedulerTests(SimpleTestCase):
+    def advance_at(self, scheduler, now):
+        with mock.patch("game_sockets.scheduler.time.perf_counter", return_value=now):
+            return scheduler.advance()
+
+    def test_steps_follow_the_wall_time(self):
+        scheduler = TickScheduler(tick_rate=60, max_catchup_steps=5)
+        self.assertEqual(self.advance_at(scheduler, 100.0), 1)
+        self.assertEqual(self.advance_at(scheduler, 100.0 + 1 / 60), 1)
+        self.assertEqual(self.advance_at(scheduler, 100.0 + 4 / 60), 3)
+        self.assertEqual(scheduler.dropped_steps, 0)
+
+    def test_catch_up_is_capped(self):
+        scheduler = TickScheduler(tick_rate=60, max_catchup_steps=5)
+        self.advance_at(scheduler, 100.0)
+        # A one second stall runs 5 steps and drops the other 55
+        self.assertEqual(self.advance_at(scheduler, 101.0), 5)
+        self.assertEqual(scheduler.dropped_steps, 55)
+        self.assertEqual(scheduler.accumulator, 0.0)
+        # The next tick is on time again instead of a burst of catch up ticks
+        self.assertEqual(self.advance_at(scheduler, 101.0 + 1 / 60), 1)
+        self.assertEqual(scheduler.dropped_steps, 0)
+
+
+class ConsistentHashRingTests(SimpleTestCase):
+    KEYS = ["game_%d_%d" % (i, i + 1) for i in range(2000)]
+
+    def owners(self, ring):
+        return {key: ring.get_node(key) for key in self.KEYS}
+
+    def test_same_nodes_same_owners(self):
+        nodes = ["game_engine.%d" % shard for shard in range(4)]
+        self.assertEqual(self.owners(ConsistentHashRing(nodes)), self.owners(ConsistentHashRing(reversed(nodes))))
+
+    def test_adding_a_node_only_moves_keys_to_it(self):
+        ring = ConsistentHashRing(["game_engine.%d" % shard for shard in range(4)])
+        before = self.owners(ring)
+        ring.add_node("game_engine.4")
+        after = self.owners(ring)
+        moved = [key for key in self.KEYS if before[key] != after[key]]
+        self.assertTrue(all(after[key] == "game_engine.4" for key in moved))
+        self.assertLess(abs(len(moved) / len(self.KEYS) - 1 / 5), 0.1)
+
+    def test_removing_a_node_only_moves_its_keys(self):
+        ring = ConsistentHashRing(["game_engine.%d" % shard for shard in range(4)])
+        before = self.owners(ring)
+        ring.remove_node("game_engine.2")
+        after = self.owners(ring)
+        for key in self.KEYS:
+            if before[key] == "game_engine.2":
+                self.assertNotEqual(after[key], "game_engine.2")
+            else:
+                self.assertEqual(after[key], before[key])
+
+
+@skipIf(np is None, "numpy is not installed")
+class BatchPhysicsTests(SimpleTestCase):
+    PADDLE_MIN = GameEngine.PADDLE_MIN
+    PADDLE_MAX = GameEngine.PADDLE_MAX
+    HISTORY_SIZE = 8
+
+    def test_matches_the_scalar_physics(self):
+        rng = random.Random(1)
+        games = 2000
+        step_scale = 0.5
+        batch = BatchPhysics(self.PADDLE_MIN, self.PADDLE_MAX, step_scale, history_size=self.HISTORY_SIZE)
+        batch.grow(games)
+        scalar = []
+        for slot in range(games):
+            game = {
+                "x": rng.uniform(10, 90), "y": rng.uniform(2, 98),
+                "vx": rng.choice([-1, 1]) * rng.uniform(0.5, 30), "vy": rng.choice([-1, 1]) * rng.uniform(0, 30),
+                "paddle_left": rng.uniform(16, 84), "paddle_right": rng.uniform(16, 84),
+                "paddle_left_direction": rng.choice([-1, 0, 1]), "paddle_right_direction": rng.choice([-1, 0, 1]),
+                "paddle_step": rng.choice([1.0, 1.25]), "kicked": rng.random() < 0.9,
+                "rewind_left": rng.randrange(self.HISTORY_SIZE), "rewind_right": rng.randrange(self.HISTORY_SIZE),
+            }
+            for field, value in game.items():
+                getattr(batch, field)[slot] = value
+            batch.playing[slot] = True
+            batch.reset_history(slot)
+            game["history"] = deque([(game["paddle_left"], game["paddle_right"])], maxlen=self.HISTORY_SIZE)
+            scalar.append(game)
+
+        for _ in range(50):
+            left_goals, right_goals = batch.step()
+            expected_left, expected_right = [], []
+            for slot, game in enumerate(scalar):
+                # The ball went out on the left when the right player scored
+                scorer = self.step_scalar(game, step_scale)
+                if scorer == "right":
+                    expected_left.append(slot)
+                elif scorer == "left":
+                    expected_right.append(slot)
+            self.assertEqual(left_goals, expected_left)
+            self.assertEqual(right_goals, expected_right)
+            for field in ("x", "y", "vx", "vy", "paddle_left", "paddle_right"):
+                self.assertTrue(np.allclose(getattr(batch, field)[:games], [game[field] for game in scalar]), field)
+
+    def step_scalar(self, game, step_scale):
+        for side in ("left", "right"):
+            paddle = game["paddle_" + side] + game["paddle_%s_direction" % side] * game["paddle_step"]
+            game["paddle_" + side] = min(max(paddle, self.PADDLE_MIN), self.PADDLE_MAX)
+        history = game["history"]
+        history.append((game["paddle_left"], game["paddle_right"]))
+        if not game["kicked"]:
+            return None
+        last = len(history) - 1
+        rewound_left = history[max(last - game["rewind_left"], 0)][0] if game["rewind_left"] else None
+        rewound_right = history[max(last - game["rewind_right"], 0)][1] if game["rewind_right"] else None
+        game["x"], game["y"], game["vx"], game["vy"], scorer = sweep_ball(
+            game["x"], game["y"], game["vx"], game["vy"], game["paddle_left"], game["paddle_right"],
+            step_scale, rewound_left, rewound_right)
+        if scorer is not None:
+            game["kicked"] = False
+        return scorer
+
+
+class DeadlineHeapTests(SimpleTestCase):
+    def test_stale_deadlines_are_skipped(self):
+        deadlines = DeadlineHeap()
+        deadlines.schedule("game_1_2", "start", 10)
+        # Replaces the first deadline, which stays in the heap
+        deadlines.schedule("game_1_2", "disconnection", 20)
+        deadlines.schedule("game_3_4", "invite", 5)
+        deadlines.cancel("game_3_4")
+        self.assertEqual(len(deadlines), 1)
+
+        now = time.monotonic()
+        self.assertEqual(deadlines.pop_expired(now + 15), [])
+        self.assertEqual(deadlines.pop_expired(now + 25), [("game_1_2", "disconnection")])
+        self.assertEqual(deadlines.pop_expired(now + 50), [])
+        self.assertEqual(len(deadlines), 0)
+        self.assertEqual(deadlines.heap, [])
+
+
+class SweepBallTests(SimpleTestCase):
+    def test_fast_ball_bounces_on_the_paddle(self):
+        # 40 units in a step is far more than the paddle is thick
+        x, y, vx, vy, scorer = sweep_ball(80, 50, 40, 0, 50, 50)
+        self.assertIsNone(scorer)
+        self.assertEqual(vx, -40)
+        self.assertEqual(x, RIGHT_PADDLE_FACE - 27.5)
+
+    def test_fast_ball_scores_past_the_paddle(self):
+        x, y, vx, vy, scorer = sweep_ball(80, 50, 40, 0, 50, 10)
+        self.assertEqual(scorer, "left")
+        self.assertEqual(x, BALL_MAX)
+
+    def test_several_bounces_in_one_step(self):
+        # Top wall after 0.2425, bottom wall after 0.485 more
+        x, y, vx, vy, scorer = sweep_ball(50, 50, 0, 200, 50, 50)
+        self.assertIsNone(scorer)
+        self.assertEqual(vy, 200)
+        self.assertAlmostEqual(y, 56.0)
+
+    def test_ball_stops_on_the_contact_point(self):
+        x, y, vx, vy, scorer = sweep_ball(90, 50, 5, 2, 50, 50, duration=0.5)
+        self.assertEqual((x, y, vx, vy, scorer), (RIGHT_PADDLE_FACE, 51.0, -5, 2, None))
+
+    def test_rewound_paddle_blocks_the_ball(self):
+        x, y, vx, vy, scorer = sweep_ball(80, 50, 40, 0, 50, 10, rewound_right=45)
+        self.assertIsNone(scorer)
+        self.assertEqual(vx, -40)
+
+
+class ImmediatePersistence(NullPersistence):
+    # Writes the input logs as soon as they are flushed
+    def submit(self, job, *args):
+        job(*args)
+
+
+@override_settings(**ENGINE_SETTINGS)
+class ReplayTests(SimpleTestCase):
+    GROUP_NAME = "game_1_2"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def play(self, disconnect=False):
+        """
+        Play a game until its end and return the path of its input log. The
+        left player kicks the ball and holds UP from the tick 35, the right
+        one moves with the legacy input model, also while the game is paused.
+        """
+        with self.settings(GAME_INPUT_LOG_DIR=self.directory):
+            engine = GameEngine("test")
+            engine.persistence = ImmediatePersistence()
+            engine.add_player(self.GROUP_NAME, 1, 42, None)
+            engine.add_player(self.GROUP_NAME, 2, 42, None)
+            game = engine.games[self.GROUP_NAME]
+            for step in range(20000):
+                if game.status == game.GameStatus.FINISHED:
+                    break
+                if step == 35:
+                    engine.inputs.put(self.GROUP_NAME, 1, "UP", "press", game.tick - 3)
+                if disconnect and step == 40:
+                    engine.remove_player(self.GROUP_NAME, 1)
+                if disconnect and step == 60:
+                    engine.add_player(self.GROUP_NAME, 1, 42, None)
+                if game.status == game.GameStatus.PAUSED:
+                    engine.inputs.put(self.GROUP_NAME, 2, "DOWN", None)
+                elif step % 7 == 0:
+                    engine.inputs.put(self.GROUP_NAME, 2, "UP" if step % 14 else "DOWN", None)
+                if not game.dotKicked:
+                    engine.inputs.put(self.GROUP_NAME, 1, "ENTER", None)
+                engine.tick(1)
+            self.assertEqual(game.status, game.GameStatus.FINISHED)
+            return game.input_log.path
+
+    def replay(self, path):
+        header, inputs, result = read_input_log(path)
+        game = ReplayEngine(header["tick_rate"], header["lag_window"]).replay(header, inputs, result["tick"])
+        self.assertEqual(result, {"tick": game.tick, "result": [game.playerLeftScore, game.playerRightScore]})
+        return inputs
+
+    def test_replay_matches_the_game(self):
+        self.replay(self.play())
+
+    def test_replay_matches_the_game_with_a_disconnection(self):
+        inputs = self.replay(self.play(disconnect=True))
+        actions = [entry[1:4] for entry in inputs]
+        # The key held when leaving is released and the connections are
+        # logged, the replay goes through them again
+        self.assertIn([1, "UP", "release"], actions)
+        self.assertIn([1, DISCONNECT_ACTION, None], actions)
+        self.assertEqual(actions.count([1, CONNECT_ACTION, None]), 2)
+
+    @skipIf(np is None, "numpy is not installed")
+    def test_replay_matches_the_batch_game_with_a_disconnection(self):
+        with self.settings(GAME_ENGINE_BATCH_PHYSICS=True):
+            path = self.play(disconnect=True)
+        self.replay(path)
+
+
+class EngineTestCase(SimpleTestCase):
+    """
+    Engine whose messages are kept in `sent` instead of being sent.
+    """
+
+    def setUp(self):
+        self.sent = []
+        self.engine = GameEngine("test")
+        self.engine.persistence = NullPersistence()
+        self.engine.send_group = lambda group_name, event: self.sent.append(event)
+
+    def new_game(self, status=None, group_name="game_1_2"):
+        game = self.engine.new_game(group_name)
+        self.engine.games[group_name] = game
+        game.status = status or game.GameStatus.PLAYING
+        return game
+
+    def frames(self):
+        """
+        Frames sent since the last call, decoded.
+        """
+        frames = [json.loads(event["text"]) for event in self.sent if event["type"] == "game_frame"]
+        self.sent.clear()
+        return frames
+
+
+@override_settings(GAME_TICK_RATE=60, GAME_SEND_RATE=60, GAME_KEYFRAME_INTERVAL=10, GAME_IDLE_HEARTBEAT=0,
+                   **ENGINE_SETTINGS)
+class DeltaBroadcastTests(EngineTestCase):
+    def test_deltas_between_keyframes(self):
+        game = self.new_game()
+        self.engine.tick(1)
+        [frame] = self.frames()
+        self.assertEqual(set(frame["game_dict"]), {"paddle_right", "paddle_left", "ball", "tick", "time"})
+
+        # Only the ball moves, the deltas until the next keyframe only carry it
+        game.dotKicked = True
+        for _ in range(10):
+            self.engine.tick(1)
+        frames = self.frames()
+        self.assertEqual([list(frame) for frame in frames], [["game_delta"]] * 9 + [["game_dict"]])
+        for frame in frames[:-1]:
+            self.assertEqual(set(frame["game_delta"]), {"ball", "tick", "time"})
+        self.assertEqual(frames[-1]["game_dict"]["ball"], [game.dotX, game.dotY])
+        self.assertEqual(frames[-1]["game_dict"]["tick"], 11)
+
+    def test_keyframe_when_a_player_joins(self):
+        game = self.new_game()
+        game.dotKicked = True
+        self.engine.tick(1)
+        self.engine.tick(1)
+        self.frames()
+        game.add_player(1, None, None)
+        self.engine.tick(1)
+        [frame] = self.frames()
+        self.assertIn("game_dict", frame)
+
+
+class ProtocolTests(SimpleTestCase):
+    SNAPSHOT = GameSnapshot(paddle_right=62.5, paddle_left=30.0, ball=(12.25, 80.5), tick=70000)
+
+    def test_state_frame_layout(self):
+        frame = pack_state_frame(self.SNAPSHOT, 1700000000123.4)
+        self.assertEqual(len(frame), 29)
+        self.assertEqual(STATE_FRAME.unpack(frame), (STATE_FRAME_TYPE, 70000, 1700000000123.4, 12.25, 80.5, 30.0, 62.5))
+
+    def test_binary_and_text_frames_agree(self):
+        event = state_event("game_dict", self.SNAPSHOT._asdict(), self.SNAPSHOT, 1700000000123.4)
+        self.assertEqual(event["type"], "game_frame")
+        self.assertEqual(event["bytes"], pack_state_frame(self.SNAPSHOT, 1700000000123.4))
+        state = json.loads(event["text"])["game_dict"]
+        _, tick, frame_time, ball_x, ball_y, paddle_left, paddle_right = STATE_FRAME.unpack(event["bytes"])
+        self.assertEqual((state["tick"], state["time"]), (tick, frame_time))
+        self.assertEqual((state["ball"], state["paddle_left"], state["paddle_right"]),
+                         ([ball_x, ball_y], paddle_left, paddle_right))
+
+    def test_binary_clients_get_the_bytes(self):
+        event = state_event("game_delta", {"ball": list(self.SNAPSHOT.ball)}, self.SNAPSHOT, 1700000000123.4)
+        for binary, sent in ((True, {"bytes_data": event["bytes"]}), (False, {"text_data": event["text"]})):
+            consumer = ClientConsumer()
+            consumer.binary = binary
+            consumer.send = mock.AsyncMock()
+            async_to_sync(consumer.game_frame)(event)
+            consumer.send.assert_awaited_once_with(**sent)
+
+
+class GamePersistenceTests(TransactionTestCase):
+    # Written outside of a transaction, like the thread of the engine does
+    def setUp(self):
+        left = User.objects.create(username="left")
+        right = User.objects.create(username="right")
+        self.winner = left
+        self.games = [Game.objects.create(playerLeft=left, playerRight=right) for _ in range(3)]
+
+    def test_updates_are_coalesced(self):
+        persistence = GamePersistence()
+        for score in range(1, 4):
+            for game in self.games:
+                persistence.update(Game, game.id, playerLeftScore=score, playerRightScore=score - 1)
+        persistence.update(Game, self.games[0].id, status=Game.GameStatus.FINISHED, winner_id=self.winner.id)
+        persistence.update(Game, None, status=Game.GameStatus.FINISHED)
+        self.assertEqual(len(persistence.pending), 3)
+
+        # One bulk_update for the finished game, one for the two others
+        with CaptureQueriesContext(connection) as queries:
+            persistence.process()
+        self.assertEqual(len([query for query in queries if query["sql"].startswith("UPDATE")]), 2)
+        self.assertEqual(persistence.pending, {})
+        rows = Game.objects.order_by("id").values_list("playerLeftScore", "playerRightScore", "status", "winner_id")
+        self.assertEqual(list(rows), [(3, 2, Game.GameStatus.FINISHED, self.winner.id),
+                                      (3, 2, Game.GameStatus.WAITING, None),
+                                      (3, 2, Game.GameStatus.WAITING, None)])
+
+    def test_jobs_run_after_the_updates_queued_before_them(self):
+        persistence = GamePersistence()
+        game_id = self.games[0].id
+        statuses = []
+        persistence.update(Game, game_id, status=Game.GameStatus.FINISHED)
+        persistence.submit(lambda: statuses.append(Game.objects.get(id=game_id).status))
+        persistence.update(Game, game_id, status=Game.GameStatus.PAUSED)
+        persistence.process()
+        # The update queued after the job is written with it, on this run
+        self.assertEqual(statuses, [Game.GameStatus.PAUSED])
+
+
+class MemoryCheckpoints():
+    # Stands in for the Redis hash of CheckpointStore, states go through JSON
+    def __init__(self):
+        self.checkpoints = {}
+
+    def save(self, group_name, state):
+        self.checkpoints[group_name] = json.dumps(state)
+
+    def delete(self, group_name):
+        self.checkpoints.pop(group_name, None)
+
+    def load(self):
+        return {group_name: json.loads(state) for group_name, state in self.checkpoints.items()}
+
+
+@override_settings(**ENGINE_SETTINGS)
+class CheckpointTests(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.store = MemoryCheckpoints()
+        self.engine.checkpoints = self.store
+
+    def restarted_engine(self):
+        engine = GameEngine("test")
+        engine.persistence = NullPersistence()
+        engine.send_group = lambda group_name, event: None
+        engine.checkpoints = self.store
+        engine.restore_games()
+        return engine
+
+    def test_restored_game_plays_on_the_same_way(self):
+        game = self.new_game()
+        game.dotKicked = True
+        game.paddleLeftDirection = 1
+        game.playerLeftScore = 2
+        for _ in range(20):
+            self.engine.tick(1)
+        self.engine.checkpoint_game(game)
+
+        engine = self.restarted_engine()
+        restored = engine.games["game_1_2"]
+        self.assertEqual(restored.checkpoint(), game.checkpoint())
+        self.assertTrue(restored.keyframe_pending)
+        # Goals included, the seed serves the next points the same way
+        for _ in range(400):
+            self.engine.tick(1)
+            engine.tick(1)
+            for playing in (game, restored):
+                if not playing.dotKicked:
+                    playing.dotKicked = True
+        self.assertGreater(game.playerLeftScore + game.playerRightScore, 2)
+        self.assertEqual(restored.checkpoint(), game.checkpoint())
+
+    def test_paused_game_keeps_its_forfeit_deadline(self):
+        game = self.new_game(GameInstance.GameStatus.PAUSED)
+        game.playerLeftStatus = game.PlayerStatus.PLAYING
+        game.playerRightStatus = game.PlayerStatus.DISCONNECTED
+        game.disconnection_time = timezone.now() - timedelta(seconds=100)
+        self.engine.checkpoint_game(game)
+
+        engine = self.restarted_engine()
+        restored = engine.games["game_1_2"]
+        self.assertEqual(restored.disconnection_time, game.disconnection_time)
+        # The disconnection happened long before the restart
+        engine.tick(1)
+        self.assertEqual(restored.status, restored.GameStatus.FINISHED)
+        self.assertEqual(restored.winner_id, 1)
+
+    def test_finished_games_are_not_checkpointed(self):
+        game = self.new_game()
+        self.engine.checkpoint_game(game)
+        self.assertIn("game_1_2", self.store.checkpoints)
+        game.status = game.GameStatus.FINISHED
+        self.engine.checkpoint_game(game)
+        self.assertEqual(self.store.checkpoints, {})
+
+    def test_broken_checkpoints_are_dropped(self):
+        self.store.checkpoints["game_1_2"] = json.dumps(["not", "a", "game"])
+        self.assertEqual(self.restarted_engine().games, {})
+        self.assertEqual(self.store.checkpoints, {})
+
+
+@override_settings(GAME_TICK_RATE=60, GAME_SEND_RATE=30, GAME_KEYFRAME_INTERVAL=60, GAME_IDLE_HEARTBEAT=0.5,
+                   **ENGINE_SETTINGS)
+class BroadcastRateTests(EngineTestCase):
+    def frame_ticks(self):
+        return [(key, payload["tick"]) for frame in self.frames() for key, payload in frame.items()]
+
+    def test_frames_follow_the_send_rate(self):
+        game = self.new_game()
+        game.dotKicked = True
+        for _ in range(9):
+            self.engine.tick(1)
+        self.assertEqual(self.frame_ticks(), [("game_dict", 1)] + [("game_delta", tick) for tick in (3, 5, 7, 9)])
+
+    def test_idle_games_only_send_heartbeats(self):
+        # Nothing moves before the ball is kicked
+        self.new_game()
+        for _ in range(70):
+            self.engine.tick(1)
+        self.assertEqual(self.frame_ticks(), [("game_dict", 1), ("game_dict", 31), ("game_dict", 61)])
+
+    def test_paused_games_send_nothing(self):
+        self.new_game(GameInstance.GameStatus.PAUSED)
+        for _ in range(70):
+            self.engine.tick(1)
+        self.assertEqual(self.sent, [])
+
+    def test_a_joining_player_gets_a_keyframe_at_once(self):
+        game = self.new_game()
+        self.engine.tick(1)
+        self.frames()
+        game.add_player(2, None, None)
+        self.engine.tick(1)
+        self.assertEqual(self.frame_ticks(), [("game_dict", 2)])
+
+
+class InputMailboxTests(SimpleTestCase):
+    def test_only_the_latest_input_of_a_key_is_kept(self):
+        mailbox = InputMailbox()
+        mailbox.put("game_1_2", 1, "UP", "press", 10)
+        mailbox.put("game_1_2", 2, "DOWN", "press", 11)
+        mailbox.put("game_1_2", 1, "DOWN", "press", 11)
+        mailbox.put("game_1_2", 1, "UP", "release", 12)
+        inputs, received = mailbox.drain()
+        self.assertEqual(received, 4)
+        # In the order of their latest change
+        self.assertEqual(list(inputs.items()), [
+            (("game_1_2", 2, "DOWN"), ("press", 11)),
+            (("game_1_2", 1, "DOWN"), ("press", 11)),
+            (("game_1_2", 1, "UP"), ("release", 12)),
+        ])
+        self.assertEqual(mailbox.drain(), ({}, 0))
+
+    def test_inputs_are_dropped_when_the_engine_is_behind(self):
+        consumer = ClientConsumer()
+        consumer.user_id = 1
+        consumer.group_name = "game_1_2"
+        consumer.input_channel = "game_engine_input.0"
+        consumer.channel_layer = mock.Mock(send=mock.AsyncMock(side_effect=ChannelFull()))
+        consumer.close = mock.AsyncMock()
+        async_to_sync(consumer.receive)(text_data=json.dumps({"message": "UP", "state": "press", "tick": 12}))
+        consumer.channel_layer.send.assert_awaited_once()
+        consumer.close.assert_not_awaited()
+
+
+@override_settings(**ENGINE_SETTINGS)
+class InputTests(EngineTestCase):
+    def test_inputs_are_applied_at_the_start_of_the_tick(self):
+        game = self.new_game()
+        for _ in range(5):
+            self.engine.inputs.put("game_1_2", 1, "DOWN", "press")
+            self.engine.inputs.put("game_1_2", 1, "DOWN", "release")
+        self.engine.inputs.put("game_1_2", 2, "UP", "press")
+        self.engine.inputs.put("game_3_4", 3, "UP", "press")
+        self.engine.tick(1)
+        self.assertEqual(self.engine.metrics.inputs, 12)
+        self.assertEqual((game.paddleLeftDirection, game.paddleRightDirection), (0, -1))
+        self.assertEqual(game.paddle_left, 50)
+        self.assertLess(game.paddle_right, 50)
+
+
+class RecordingTests(SimpleTestCase):
+    GAME_ID = 7
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = recording_path(self.directory, self.GAME_ID)
+
+    def record(self, frames):
+        writer = RecordingWriter(self.directory)
+        recording = writer.open(self.GAME_ID)
+        for frame in frames:
+            recording.record(*frame)
+        recording.close()
+        # What the thread of the writer does
+        while not writer.jobs.empty():
+            writer.write(*writer.jobs.get())
+
+    def frames(self, count):
+        # Values a float32 holds exactly
+        return [(2 * index, index % 100 + 0.5, 50.25, 16.0, 84.0, EVENT_GOAL_LEFT if index % 50 == 0 else 0)
+                for index in range(count)]
+
+    def test_records_are_read_in_place(self):
+        frames = self.frames(RECORDS_PER_BUFFER * 2 + 10)
+        self.record(frames)
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.assertEqual(data[:len(RECORDING_MAGIC)], RECORDING_MAGIC)
+        self.assertEqual(len(data), len(RECORDING_MAGIC) + len(frames) * RECORD.size)
+        with RecordingReader(self.path) as reader:
+            self.assertEqual(len(reader), len(frames))
+            self.assertEqual(reader[0], frames[0])
+            self.assertEqual(reader[len(frames) - 1], frames[-1])
+            self.assertEqual(list(reader.frames()), frames)
+            with self.assertRaises(IndexError):
+                reader[len(frames)]
+
+    def test_frames_are_found_by_tick(self):
+        frames = self.frames(1000)
+        self.record(frames)
+        with RecordingReader(self.path) as reader:
+            self.assertEqual(reader.tick_index(0), 0)
+            self.assertEqual(reader.tick_index(101), 51)
+            self.assertEqual(reader.tick_index(10000), 1000)
+            self.assertEqual([frame[0] for frame in reader.frames(101, 110)], [102, 104, 106, 108, 110])
+            self.assertEqual(list(reader.frames(5000)), [])
+
+    def test_a_record_being_written_is_left_out(self):
+        self.record(self.frames(3))
+        with open(self.path, "ab") as f:
+            f.write(b"\x01\x02\x03")
+        with RecordingReader(self.path) as reader:
+            self.assertEqual(len(reader), 3)
+
+    def get_replay(self, user=None, **params):
+        request = APIRequestFactory().get("/replays/%d/" % self.GAME_ID, params)
+        if user is not None:
+            force_authenticate(request, user=user)
+        with self.settings(GAME_RECORDING_DIR=self.directory):
+            return game_replay(request, self.GAME_ID)
+
+    def test_replays_are_streamed_to_authenticated_users(self):
+        self.record(self.frames(100))
+        response = self.get_replay(User(username="viewer"), **{"from": 10, "to": 15})
+        self.assertEqual(response.status_code, 200)
+        async def read(content):
+            return b"".join([chunk async for chunk in content])
+
+        lines = asyncio.run(read(response.streaming_content)).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [
+            {"tick": tick, "ball": [tick // 2 + 0.5, 50.25], "paddle_left": 16.0, "paddle_right": 84.0, "events": 0}
+            for tick in (10, 12, 14)])
+
+    def test_replays_need_an_authenticated_user(self):
+        self.record(self.frames(100))
+        self.assertEqual(self.get_replay().status_code, 403)
+
+    def test_other_files_are_refused(self):
+        for data in (b"", b"PONG", b"NOTAREC1" + bytes(RECORD.size)):
+            with open(self.path, "wb") as f:
+                f.write(data)
+            with self.assertRaises(ValueError):
+                RecordingReader(self.path)
+
+
+@override_settings(GAME_TICK_RATE=60, GAME_SEND_RATE=20, **ENGINE_SETTINGS)
+class FrameStampTests(EngineTestCase):
+    def test_frames_carry_the_tick_and_the_time_of_the_tick(self):
+        game = self.new_game()
+        game.dotKicked = True
+        stamps = []
+        for now in range(1000, 1010):
+            with mock.patch("game_sockets.engine.server_time", return_value=float(now)):
+                self.engine.tick(1)
+            stamps.extend((event["text"], event["bytes"]) for event in self.sent)
+            self.sent.clear()
+        frames = [(json.loads(text), STATE_FRAME.unpack(data)) for text, data in stamps]
+        # Sent every third tick, the clients interpolate in between
+        self.assertEqual([(payload["tick"], payload["time"]) for frame, _ in frames for payload in frame.values()],
+                         [(1, 1000.0), (4, 1003.0), (7, 1006.0), (10, 1009.0)])
+        self.assertEqual([unpacked[1:3] for _, unpacked in frames], [(1, 1000.0), (4, 1003.0), (7, 1006.0), (10, 1009.0)])
+
+    def test_clock_sync_reply(self):
+        with mock.patch("game_sockets.protocol.time.time", return_value=1700000000.5):
+            reply = json.loads(sync_reply(123.5))
+        self.assertEqual(reply, {"sync": {"client_time": 123.5, "server_time": 1700000000500.0}})
+
+
+class NetworkQualityTests(SimpleTestCase):
+    def test_smoothed_round_trip_and_jitter(self):
+        network = NetworkQuality()
+        self.assertEqual(network.to_dict(), {"rtt": None, "srtt": None, "min_rtt": None, "jitter": 0.0, "samples": 0})
+        for rtt in (0.100, 0.140, 0.080):
+            network.observe(rtt)
+        measures = network.to_dict()
+        # srtt += (rtt - srtt) / 8, jitter += (|rtt - previous rtt| - jitter) / 16
+        self.assertAlmostEqual(measures.pop("srtt"), 0.101875)
+        self.assertAlmostEqual(measures.pop("jitter"), 0.00609375)
+        self.assertEqual(measures, {"rtt": 0.080, "min_rtt": 0.080, "samples": 3})
+
+
+@override_settings(**ENGINE_SETTINGS)
+class PlayerNetworkTests(EngineTestCase):
+    def test_measures_of_the_players_are_kept_until_they_leave(self):
+        network = NetworkQuality()
+        self.engine.player_network(1, network.to_dict())
+        self.assertEqual(self.engine.network, {})
+        network.observe(0.05)
+        self.engine.player_network(1, network.to_dict())
+        self.assertEqual(self.engine.network[1]["srtt"], 0.05)
+        self.assertEqual(self.engine.metrics.client_rtt.count, 1)
+        self.new_game()
+        self.engine.remove_player("game_1_2", 1)
+        self.assertEqual(self.engine.network, {})
+
+
+@skipIf(np is None, "numpy is not installed")
+@override_settings(GAME_TICK_RATE=60, GAME_SEND_RATE=30, GAME_KEYFRAME_INTERVAL=60, GAME_IDLE_HEARTBEAT=0.5,
+                   **ENGINE_SETTINGS)
+class BatchBroadcastTests(SimpleTestCase):
+    def play(self, batch):
+        """
+        Events sent by 3 games over 600 ticks, with kicks every 100 ticks so
+        the games are idle between the points.
+        """
+        sent = []
+        with self.settings(GAME_ENGINE_BATCH_PHYSICS=batch):
+            engine = GameEngine("test")
+        engine.persistence = NullPersistence()
+        # Compared decoded, the batch sends the paddles as floats
+        engine.send_group = lambda group_name, event: sent.append((group_name, json.loads(event["text"])))
+        for seed in range(3):
+            group_name = "game_%d_%d" % (2 * seed + 1, 2 * seed + 2)
+            game = engine.games[group_name] = engine.new_game(group_name, seed)
+            game.status = game.GameStatus.PLAYING
+        with mock.patch("game_sockets.engine.server_time", return_value=1000.0):
+            for step in range(600):
+                if step % 100 == 0:
+                    for game in engine.games.values():
+                        engine.inputs.put(game.group_name, game.playerLeftId, "ENTER", None)
+                if step % 40 == 0:
+                    engine.inputs.put("game_1_2", 1, "UP", "press" if step % 80 else "release")
+                if step == 250:
+                    engine.games["game_3_4"].add_player(3, None, None)
+                engine.tick(1)
+        # The batch scores the goals of every game before sending the frames
+        return sorted(sent, key=lambda event: event[0])
+
+    def test_batch_frames_are_the_scalar_frames(self):
+        sent = self.play(batch=False)
+        self.assertEqual(self.play(batch=True), sent)
+        kinds = {key for _, event in sent for key in event}
+        self.assertEqual(kinds, {"game_dict", "game_delta", "score_dict"})
+
+
+@override_settings(**ENGINE_SETTINGS)
+class OverrunLogTests(EngineTestCase):
+    def run_late_tick(self, now):
+        self.engine.scheduler.dropped_steps = 10
+        with mock.patch("game_sockets.engine.time.monotonic", return_value=now), \
+                mock.patch("builtins.print") as log:
+            self.engine.run_tick(5)
+        return [call.args[0] for call in log.call_args_list]
+
+    def test_overruns_are_logged_once_per_interval(self):
+        logs = [line for now in (100.0, 100.2, 100.5, 100.9) for line in self.run_late_tick(now)]
+        self.assertEqual(len(logs), 1)
+        self.assertIn("1 ticks late, 10 steps dropped", logs[0])
+        # The report sums the overruns since the previous one
+        [log] = self.run_late_tick(101.0)
+        self.assertIn("4 ticks late, 40 steps dropped", log)
+        self.assertEqual(self.engine.metrics.dropped_steps, 50)
+
+
+@override_settings(**ENGINE_SETTINGS)
+class AsyncEngineTests(SimpleTestCase):
+    def run_engine(self, tick):
+        async def run():
+            engine = AsyncGameEngine("test")
+            engine.persistence = NullPersistence()
+            engine.tick = lambda steps: tick(engine)
+            engine.start()
+            await asyncio.wait_for(engine.task, 5)
+            return engine
+
+        with mock.patch("builtins.print") as log, mock.patch("traceback.print_exc"):
+            engine = asyncio.run(run())
+        return engine, [call.args[0] for call in log.call_args_list]
+
+    def test_a_failing_tick_does_not_stop_the_engine(self):
+        ticks = []
+
+        def tick(engine):
+            ticks.append(len(ticks))
+            if len(ticks) == 2:
+                raise ValueError("broken game")
+            if len(ticks) == 5:
+                engine.stop()
+
+        engine, logs = self.run_engine(tick)
+        self.assertEqual(len(ticks), 5)
+        self.assertEqual(logs, ["Error running the engine tick: "])
+        self.assertTrue(engine.task.done())
+
+    def test_a_stopped_engine_is_logged(self):
+        async def run():
+            engine = AsyncGameEngine("test")
+            engine.start_services = mock.Mock(side_effect=RuntimeError("no redis"))
+            engine.start()
+            await asyncio.wait([engine.task])
+            await asyncio.sleep(0)
+
+        with mock.patch("builtins.print") as log:
+            asyncio.run(run())
+        log.assert_called_once_with("Error: the game engine stopped: ", "RuntimeError('no redis')")
+
+
+class FanoutTests(SimpleTestCase):
+    SNAPSHOT = GameSnapshot(paddle_right=50, paddle_left=40, ball=(20.0, 30.0), tick=12)
+
+    def channel_layer(self):
+        return mock.Mock(group_send=mock.AsyncMock())
+
+    def sent(self, fanout):
+        return [(call.args[0], call.args[1]["close"], json.loads(call.args[1]["text"]))
+                for call in fanout.channel_layer.group_send.await_args_list]
+
+    def test_only_the_latest_frame_of_a_game_is_sent(self):
+        for fanout in (SpectatorFanout(), LoopFanout()):
+            fanout.channel_layer = self.channel_layer()
+            fanout.publish_state("game_1_2", self.SNAPSHOT, 0, 0, 1000.0)
+            fanout.publish_state("game_1_2", self.SNAPSHOT._replace(tick=13), 1, 0, 1001.0)
+            fanout.publish_state("game_3_4", self.SNAPSHOT, 2, 2, 1001.0)
+            asyncio.run(fanout.send_pending())
+            self.assertEqual(self.sent(fanout), [
+                ("game_1_2_spectators", False, {"game_dict": {"paddle_right": 50, "paddle_left": 40, "ball": [20.0, 30.0],
+                                                              "tick": 13, "time": 1001.0},
+                                                "score_dict": {"left": 1, "right": 0}}),
+                ("game_3_4_spectators", False, {"game_dict": {"paddle_right": 50, "paddle_left": 40, "ball": [20.0, 30.0],
+                                                              "tick": 12, "time": 1001.0},
+                                                "score_dict": {"left": 2, "right": 2}}),
+            ])
+            asyncio.run(fanout.send_pending())
+            self.assertEqual(len(self.sent(fanout)), 2)
+
+    def test_the_end_of_a_game_is_never_replaced(self):
+        for fanout in (SpectatorFanout(), LoopFanout()):
+            fanout.channel_layer = self.channel_layer()
+            fanout.publish_end("game_1_2", 1, 5, 3)
+            fanout.publish_state("game_1_2", self.SNAPSHOT, 5, 3, 1000.0)
+            asyncio.run(fanout.send_pending())
+            self.assertEqual(self.sent(fanout), [("game_1_2_spectators", True, {"end_dict": {
+                "end": "Game finished", "winner": 1, "score": {"left": 5, "right": 3}}})])
+
+    def test_loop_fanout_sends_from_its_task(self):
+        async def run(fanout):
+            fanout.start()
+            fanout.publish_state("game_1_2", self.SNAPSHOT, 0, 0, 1000.0)
+            for _ in range(3):
+                await asyncio.sleep(0)
+            fanout.task.cancel()
+
+        fanout = LoopFanout()
+        fanout.channel_layer = self.channel_layer()
+        asyncio.run(run(fanout))
+        self.assertEqual([group_name for group_name, _, _ in self.sent(fanout)], ["game_1_2_spectators"])
+
+
+@override_settings(GAME_TICK_RATE=60, GAME_SPECTATOR_SEND_RATE=10, **ENGINE_SETTINGS)
+class SpectatorTests(EngineTestCase):
+    def test_watched_games_are_sent_at_the_spectator_rate(self):
+        self.engine.fanout = mock.Mock()
+        self.new_game()
+        self.new_game(group_name="game_3_4")
+        self.engine.spectator_join("game_1_2")
+        for _ in range(12):
+            self.engine.tick(1)
+        self.assertEqual([call.args[1].tick for call in self.engine.fanout.publish_state.call_args_list], [1, 7])
+        self.engine.end_game("game_1_2")
+        self.engine.fanout.publish_end.assert_called_once_with("game_1_2", None, 0, 0)
+
+
+@override_settings(GAME_DISCONNECTION_TIMEOUT=30, GAME_START_TIMEOUT=120, **ENGINE_SETTINGS)
+class DisconnectionTimeoutTests(EngineTestCase):
+    def at(self, now, job, *args):
+        with mock.patch("game_sockets.timers.time.monotonic", return_value=now):
+            job(*args)
+
+    def ends(self):
+        return [json.loads(event["text"])["end_dict"] for event in self.sent if event["type"] == "game_end"]
+
+    def test_lone_player_coming_back_does_not_pause_the_game_forever(self):
+        self.at(100, self.engine.add_player, "game_1_2", 1, 42, None)
+        self.at(100, self.engine.remove_player, "game_1_2", 1)
+        self.at(110, self.engine.add_player, "game_1_2", 1, 42, None)
+        game = self.engine.games["game_1_2"]
+        self.assertEqual(game.status, game.GameStatus.PAUSED)
+
+        # The opponent never joins
+        self.at(135, self.engine.tick, 1)
+        self.assertEqual(self.ends(), [])
+        self.at(141, self.engine.tick, 1)
+        self.assertEqual(self.ends(), [{"end": "Game not contested", "winner": None}])
+        self.assertEqual(game.status, game.GameStatus.FINISHED)
+        self.assertNotIn("game_1_2", self.engine.games)
+
+    def test_disconnected_player_forfeits(self):
+        self.at(100, self.engine.add_player, "game_1_2", 1, 42, None)
+        self.at(100, self.engine.add_player, "game_1_2", 2, 42, None)
+        self.at(110, self.engine.remove_player, "game_1_2", 2)
+        self.at(139, self.engine.tick, 1)
+        self.assertEqual(self.ends(), [])
+        self.at(141, self.engine.tick, 1)
+        self.assertEqual(self.ends(), [{"end": "Game finished", "winner": 1}])
+
+    def test_player_coming_back_in_time_resumes_the_game(self):
+        self.at(100, self.engine.add_player, "game_1_2", 1, 42, None)
+        self.at(100, self.engine.add_player, "game_1_2", 2, 42, None)
+        self.at(110, self.engine.remove_player, "game_1_2", 2)
+        self.at(120, self.engine.add_player, "game_1_2", 2, 42, None)
+        self.at(200, self.engine.tick, 1)
+        game = self.engine.games["game_1_2"]
+        self.assertEqual(game.status, game.GameStatus.PLAYING)
+        self.assertEqual(self.ends(), [])
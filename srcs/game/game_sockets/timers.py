@@ -0,0 +1,44 @@
+import heapq
+import time
+
+
+class DeadlineHeap():
+    """
+    Min-heap of the deadlines of the games, on the monotonic clock.
+
+    A key has at most one live deadline: scheduling it again or cancelling it
+    leaves the old entry in the heap, where it is skipped when popped. The
+    engine only looks at the deadlines that expired, never at every game.
+    """
+
+    def __init__(self):
+        self.heap = []
+        # key -> token of its live deadline
+        self.tokens = {}
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def schedule(self, key, kind, delay):
+        self.counter += 1
+        self.tokens[key] = self.counter
+        heapq.heappush(self.heap, (time.monotonic() + delay, self.counter, key, kind))
+
+    def cancel(self, key):
+        self.tokens.pop(key, None)
+
+    def pop_expired(self, now=None):
+        """
+        Remove and return the (key, kind) of every deadline before `now`.
+        """
+        if now is None:
+            now = time.monotonic()
+        expired = []
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            _, token, key, kind = heapq.heappop(heap)
+            if self.tokens.get(key) == token:
+                del self.tokens[key]
+                expired.append((key, kind))
+        return expired
@@ -1,7 +1,11 @@
 from . import consumers
+from . import views
 from django.urls import path
     
 urlpatterns = [
     # path('ws/game/<str:room>/', consumers.ClientConsumer.as_asgi()),
     path('ws/game/', consumers.ClientConsumer.as_asgi()),
+    path('metrics/', views.engine_metrics),
+    path('network/', views.network_quality),
+    path('replays/<int:game_id>/', views.game_replay),
 ]
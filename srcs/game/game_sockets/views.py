@@ -1,3 +1,126 @@
-from django.shortcuts import render
+import json
+from itertools import islice
 
-# Create your views here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.cache import never_cache
+from rest_framework.decorators import api_view
+import redis
+
+from game_matchmaking.views import private_microservice_endpoint
+from .metrics import load_engine_metrics, render_prometheus
+from .network import load_network_quality
+from .recording import RecordingReader, recording_path
+
+'''
+Metrics of every game engine worker, in the Prometheus text format
+
+The workers push them to Redis every GAME_METRICS_INTERVAL seconds
+'''
+@never_cache
+@private_microservice_endpoint
+def engine_metrics(request):
+    client = redis.Redis(host=settings.REDIS_HOST, port=6379)
+    try:
+        snapshots = load_engine_metrics(client)
+    except redis.RedisError as e:
+        print(e)
+        return HttpResponse('error while reading the metrics', status=503, content_type='text/plain')
+    return HttpResponse(render_prometheus(snapshots), content_type='text/plain; version=0.0.4')
+
+
+'''
+Network quality of the game sockets of some users, for the matchmaking
+
+Round trip time, smoothed round trip time, minimum round trip time and
+jitter in seconds, pushed by the engine workers every GAME_METRICS_INTERVAL
+seconds. Users without an open game socket get null.
+
+Parameters:
+    - users (Required): Comma separated ids of the users
+'''
+@never_cache
+@private_microservice_endpoint
+def network_quality(request):
+    try:
+        user_ids = [int(user_id) for user_id in request.GET.get('users', '').split(',') if user_id]
+    except ValueError:
+        return JsonResponse({'error': 'users must be a comma separated list of ids'}, status=400)
+    if not user_ids:
+        return JsonResponse({'error': 'users is required'}, status=400)
+
+    client = redis.Redis(host=settings.REDIS_HOST, port=6379)
+    try:
+        networks = load_network_quality(client, user_ids)
+    except redis.RedisError as e:
+        print(e)
+        return JsonResponse({'error': 'error while reading the network quality'}, status=503)
+    return JsonResponse({'detail': {str(user_id): network for user_id, network in networks.items()}})
+
+
+# Frames read from the recording at once, so a long game is never held in
+# memory while it is sent
+REPLAY_CHUNK_FRAMES = 1024
+
+
+def _replay_chunk(frames):
+    return "".join(json.dumps({"tick": tick, "ball": [ball_x, ball_y], "paddle_left": paddle_left,
+                               "paddle_right": paddle_right, "events": events}) + "\n"
+                   for tick, ball_x, ball_y, paddle_left, paddle_right, events
+                   in islice(frames, REPLAY_CHUNK_FRAMES))
+
+
+async def _replay_lines(path, start_tick, end_tick):
+    # Async so the ASGI server sends the chunks as they are read, the files
+    # are read in a thread to keep the event loop free
+    reader = await sync_to_async(RecordingReader, thread_sensitive=False)(path)
+    try:
+        frames = reader.frames(start_tick, end_tick)
+        while True:
+            chunk = await sync_to_async(_replay_chunk, thread_sensitive=False)(frames)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        reader.close()
+
+
+'''
+Stream the recorded frames of a game, one JSON object per line
+
+The user must be authenticated to get the replays
+
+Parameters:
+    - from (Optional): First tick to send
+    - to (Optional): Last tick to send
+'''
+@never_cache
+@api_view(['GET'])
+def game_replay(request, game_id):
+    user = request.user
+
+    if not user or user is None or not user.is_authenticated:
+        return JsonResponse({'error': 'user is not authenticated'}, status=403)
+
+    if not settings.GAME_RECORDING_DIR:
+        return JsonResponse({'error': 'recordings are disabled'}, status=404)
+
+    try:
+        start_tick = int(request.query_params.get('from', 0))
+        end_tick = request.query_params.get('to')
+        end_tick = int(end_tick) if end_tick is not None else None
+    except ValueError:
+        return JsonResponse({'error': 'from and to must be ticks'}, status=400)
+
+    path = recording_path(settings.GAME_RECORDING_DIR, game_id)
+    try:
+        # Opened here so a missing or broken file is reported before streaming
+        RecordingReader(path).close()
+    except FileNotFoundError:
+        return JsonResponse({'error': 'no recording for this game'}, status=404)
+    except (OSError, ValueError) as e:
+        print(e)
+        return JsonResponse({'error': 'error while reading the recording'}, status=500)
+
+    return StreamingHttpResponse(_replay_lines(path, start_tick, end_tick), content_type='application/x-ndjson')